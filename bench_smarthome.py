@@ -0,0 +1,279 @@
+# ================================================================
+# 接口压测 / 延迟基准（使用模拟硬件，不需要树莓派）
+# ================================================================
+# 用法：
+#   python bench_smarthome.py --clients 20 --duration 30 --mix dashboard
+#   python bench_smarthome.py --mix mixed --compare bench_results/old.json
+#
+# 服务端在子进程里以 SMARTHOME_BACKEND=sim 运行，客户端按网页的真实轮询节奏
+# （/state 500ms、/cpu_temp 3s、/api/temp 5s ……）发请求，统计吞吐、
+# p50 / p95 / p99 延迟以及服务端每个请求消耗的 CPU，结果保存为 JSON
+
+import argparse
+import heapq
+import http.client
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 每种客户端的请求组合：(路径, 间隔秒数)
+MIXES = {
+    # 打开着的控制页面
+    "dashboard": [("/state", 0.5), ("/cpu_temp", 3.0), ("/api/temp", 5.0)],
+    # 频繁打开页面 / 刷新
+    "page_load": [("/", 10.0), ("/qrcode?size=360", 10.0)],
+    # 点按钮
+    "actions": [("/action/main_on", 2.0), ("/action/main_off", 2.0)],
+}
+MIXES["mixed"] = MIXES["dashboard"] + MIXES["page_load"] + MIXES["actions"]
+
+# 服务端子进程用这一行报告端口；导入时打印的其他诊断信息不影响握手
+PORT_TAG = "SMARTHOME_BENCH_PORT="
+
+
+# ================================================================
+# 服务端（子进程）
+# ================================================================
+def serve():
+    os.environ.setdefault("SMARTHOME_BACKEND", "sim")
+    sys.path.insert(0, BASE_DIR)
+    import smarthome
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)   # 不打印每个请求的访问日志
+    server = make_server("127.0.0.1", 0, smarthome.app, threaded=True)
+    print(PORT_TAG + str(server.server_port), flush=True)
+    server.serve_forever()
+
+
+def start_server(db_path):
+    env = dict(os.environ, SMARTHOME_BACKEND="sim", SMARTHOME_DB=db_path)
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve"],
+                            stdout=subprocess.PIPE, env=env, text=True)
+    return proc, read_port(proc)
+
+
+def read_port(proc):
+    for line in proc.stdout:
+        if line.startswith(PORT_TAG):
+            # 之后的输出在后台读掉，避免管道写满把服务端卡住
+            threading.Thread(target=proc.stdout.read, daemon=True).start()
+            return int(line[len(PORT_TAG):])
+    raise RuntimeError("server exited before reporting its port")
+
+
+def process_cpu_seconds(pid):
+    # Linux：从 /proc/<pid>/stat 读 utime + stime；其他系统返回 None
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# ================================================================
+# 客户端
+# ================================================================
+class Client(threading.Thread):
+
+    def __init__(self, port, mix, deadline, speed, use_etag):
+        super().__init__(daemon=True)
+        self.port = port
+        self.mix = mix
+        self.deadline = deadline
+        self.speed = speed
+        self.use_etag = use_etag
+        self.etags = {}
+        self.results = []   # (路径, 状态码, 延迟秒数)
+
+    def run(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        now = time.monotonic()
+        # 随机相位，避免所有客户端同一时刻发请求
+        queue = [(now + random.uniform(0, interval / self.speed), path, interval / self.speed)
+                 for path, interval in self.mix]
+        heapq.heapify(queue)
+
+        while queue:
+            due, path, interval = heapq.heappop(queue)
+            if due >= self.deadline:
+                continue
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.results.append(self.request(conn, path))
+            heapq.heappush(queue, (max(due + interval, time.monotonic()), path, interval))
+        conn.close()
+
+    def request(self, conn, path):
+        # 和浏览器一样带上 If-None-Match
+        headers = {"Accept-Encoding": "gzip"}
+        if self.use_etag and path in self.etags:
+            headers["If-None-Match"] = self.etags[path]
+        started = time.perf_counter()
+        try:
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            status = resp.status
+            etag = resp.getheader("ETag")
+            if etag:
+                self.etags[path] = etag
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            status = 0
+        return path, status, time.perf_counter() - started
+
+
+# ================================================================
+# 统计
+# ================================================================
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def summarize(results, duration):
+    lat = sorted(r[2] for r in results)
+    statuses = {}
+    for _, status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        "requests": len(results),
+        "errors": sum(1 for r in results if r[1] == 0 or r[1] >= 500),
+        "status": statuses,
+        "throughput_rps": round(len(results) / duration, 2),
+        "mean_ms": ms(sum(lat) / len(lat)) if lat else None,
+        "p50_ms": ms(percentile(lat, 50)),
+        "p95_ms": ms(percentile(lat, 95)),
+        "p99_ms": ms(percentile(lat, 99)),
+        "max_ms": ms(lat[-1]) if lat else None,
+    }
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       cwd=BASE_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    mix = MIXES[args.mix]
+    db_dir = tempfile.mkdtemp(prefix="smarthome-bench-")
+    proc, port = start_server(os.path.join(db_dir, "bench.db"))
+    try:
+        time.sleep(args.warmup)   # 等采样线程产生第一批数据
+        cpu_before = process_cpu_seconds(proc.pid)
+        started = time.monotonic()
+        deadline = started + args.duration
+        clients = [Client(port, mix, deadline, args.speed, not args.no_etag)
+                   for _ in range(args.clients)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        elapsed = time.monotonic() - started
+        cpu_after = process_cpu_seconds(proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    results = [r for c in clients for r in c.results]
+    routes = {}
+    for r in results:
+        routes.setdefault(r[0], []).append(r)
+
+    total = summarize(results, elapsed)
+    server = {"cpu_seconds": None, "cpu_ms_per_request": None}
+    if cpu_before is not None and cpu_after is not None:
+        server["cpu_seconds"] = round(cpu_after - cpu_before, 3)
+        if results:
+            server["cpu_ms_per_request"] = round((cpu_after - cpu_before) * 1000 / len(results), 3)
+
+    return {
+        "version": git_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "clients": args.clients, "duration": args.duration, "mix": args.mix,
+            "speed": args.speed, "etag": not args.no_etag,
+        },
+        "server": server,
+        "total": total,
+        "routes": {path: summarize(rs, elapsed) for path, rs in sorted(routes.items())},
+    }
+
+
+def print_report(report, baseline=None):
+    def delta(new, old):
+        if new is None or old is None or not old:
+            return ""
+        return " (%+.1f%%)" % ((new - old) / old * 100)
+
+    rows = [("TOTAL", report["total"])] + list(report["routes"].items())
+    old_rows = {}
+    if baseline:
+        old_rows = dict([("TOTAL", baseline["total"])] + list(baseline["routes"].items()))
+
+    print("%-22s %8s %9s %9s %9s %9s" % ("route", "req", "rps", "p50 ms", "p95 ms", "p99 ms"))
+    for name, s in rows:
+        old = old_rows.get(name, {})
+        print("%-22s %8d %9.1f %9s %9s %9s%s" % (
+            name, s["requests"], s["throughput_rps"], s["p50_ms"], s["p95_ms"], s["p99_ms"],
+            delta(s["p95_ms"], old.get("p95_ms"))))
+    server = report["server"]
+    print("server cpu: %s s, %s ms/request%s" % (
+        server["cpu_seconds"], server["cpu_ms_per_request"],
+        delta(server["cpu_ms_per_request"],
+              (baseline or {}).get("server", {}).get("cpu_ms_per_request"))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart home endpoint load test")
+    parser.add_argument("--clients", type=int, default=10, help="并发的页面数量")
+    parser.add_argument("--duration", type=float, default=30.0, help="压测时长（秒）")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="dashboard")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="轮询加速倍数，例如 10 表示间隔缩短为 1/10")
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--no-etag", action="store_true", help="不发送 If-None-Match")
+    parser.add_argument("--output", help="结果 JSON 路径（默认 bench_results/bench-<时间>.json）")
+    parser.add_argument("--compare", help="与之前保存的结果 JSON 对比")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve()
+        return
+
+    report = run(args)
+    output = args.output or os.path.join(
+        BASE_DIR, "bench_results", "bench-%s.json" % time.strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print("saved:", output)
+
+
+if __name__ == "__main__":
+    main()
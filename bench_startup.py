@@ -0,0 +1,191 @@
+# ================================================================
+# 启动耗时基准（使用模拟硬件，不需要树莓派）
+# ================================================================
+# 用法：
+#   python bench_startup.py --runs 5
+#   python bench_startup.py --compare bench_results/startup-old.json
+#
+# 两部分：
+#   1. python -X importtime 导入 smarthome，统计每个模块的导入耗时（取多次中位数）
+#   2. 以子进程启动服务端，测量 进程启动 -> 端口监听 -> /state 首次 200 -> /ready 200
+#      的时间，以及 /ready 报告的各子系统就绪时间和导入阶段各步骤耗时
+
+import argparse
+import http.client
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_smarthome import BASE_DIR, git_version, read_port
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s*(\S+)")
+
+
+# ================================================================
+# 导入耗时
+# ================================================================
+def import_times(db_path):
+    # 返回 (导入总耗时秒数, {模块: (自身微秒, 累计微秒)})。
+    # 后台线程也会导入模块，-X importtime 的缩进层级不可靠，所以保留全部模块，按累计耗时排序
+    env = dict(os.environ, SMARTHOME_BACKEND="sim", SMARTHOME_DB=db_path, PYTHONPATH=BASE_DIR)
+    code = "import time; t = time.perf_counter(); import smarthome; print(time.perf_counter() - t)"
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          env=env, cwd=tempfile.gettempdir(), capture_output=True, text=True)
+    modules = {}
+    for line in proc.stderr.splitlines():
+        m = IMPORTTIME_LINE.match(line)
+        if m:
+            modules[m.group(3)] = (int(m.group(1)), int(m.group(2)))
+    return float(proc.stdout.split()[-1]), modules
+
+
+# ================================================================
+# 启动到可用
+# ================================================================
+def get(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    except (OSError, http.client.HTTPException):
+        return 0, b""
+    finally:
+        conn.close()
+
+
+def wait_status(port, path, deadline):
+    while time.monotonic() < deadline:
+        status, body = get(port, path)
+        if status == 200:
+            return time.monotonic(), body
+        time.sleep(0.005)
+    return None, b""
+
+
+def boot_once(db_path, timeout):
+    env = dict(os.environ, SMARTHOME_BACKEND="sim", SMARTHOME_DB=db_path)
+    started = time.monotonic()
+    proc = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "bench_smarthome.py"), "--serve"],
+                            stdout=subprocess.PIPE, env=env, text=True)
+    try:
+        port = read_port(proc)
+        bound = time.monotonic()
+        deadline = bound + timeout
+        state_at, _ = wait_status(port, "/state", deadline)
+        ready_at, body = wait_status(port, "/ready", deadline)
+        report = json.loads(body) if body else {}
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    s = lambda t: round(t - started, 4) if t is not None else None
+    return {
+        "bind_s": s(bound),
+        "first_state_s": s(state_at),
+        "ready_s": s(ready_at),
+        "subsystems": {name: sub["seconds"] for name, sub in report.get("subsystems", {}).items()},
+        "boot_steps": report.get("boot_steps", {}),
+    }
+
+
+def median_of(runs, key):
+    values = [r[key] for r in runs if r.get(key) is not None]
+    return round(statistics.median(values), 4) if values else None
+
+
+def run(args):
+    db_dir = tempfile.mkdtemp(prefix="smarthome-startup-")
+    db_path = os.path.join(db_dir, "startup.db")
+
+    results = [import_times(db_path) for _ in range(args.runs)]
+    samples = [modules for _, modules in results]
+    names = set().union(*samples)
+    modules = {}
+    for name in names:
+        values = [s[name] for s in samples if name in s]
+        modules[name] = {
+            "self_ms": round(statistics.median(v[0] for v in values) / 1000, 3),
+            "cumulative_ms": round(statistics.median(v[1] for v in values) / 1000, 3),
+        }
+
+    boots = [boot_once(db_path, args.timeout) for _ in range(args.runs)]
+    subsystems = {}
+    for name in set().union(*(b["subsystems"] for b in boots)):
+        subsystems[name] = median_of([b["subsystems"] for b in boots], name)
+    steps = {}
+    for name in set().union(*(b["boot_steps"] for b in boots)):
+        steps[name] = median_of([b["boot_steps"] for b in boots], name)
+    boot = {"import_s": round(statistics.median(t for t, _ in results), 4)}
+    for key in ("bind_s", "first_state_s", "ready_s"):
+        boot[key] = median_of(boots, key)
+
+    return {
+        "version": git_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"runs": args.runs},
+        "boot": boot,
+        "subsystems": dict(sorted(subsystems.items())),
+        "boot_steps": dict(sorted(steps.items())),
+        "imports": dict(sorted(modules.items(), key=lambda kv: -kv[1]["cumulative_ms"])),
+    }
+
+
+def print_report(report, baseline=None, top=15):
+    def delta(new, old):
+        if new is None or old is None or not old:
+            return ""
+        return " (%+.1f%%)" % ((new - old) / old * 100)
+
+    base = baseline or {}
+    print("%-16s %10s" % ("boot", "seconds"))
+    for key, value in report["boot"].items():
+        print("%-16s %10s%s" % (key, value, delta(value, base.get("boot", {}).get(key))))
+    print()
+    print("%-16s %10s" % ("subsystem", "ready s"))
+    for name, value in report["subsystems"].items():
+        print("%-16s %10s%s" % (name, value, delta(value, base.get("subsystems", {}).get(name))))
+    print()
+    print("%-16s %10s" % ("boot step", "seconds"))
+    for name, value in report["boot_steps"].items():
+        print("%-16s %10s%s" % (name, value, delta(value, base.get("boot_steps", {}).get(name))))
+    print()
+    old_imports = base.get("imports", {})
+    print("%-28s %10s %10s" % ("import", "self ms", "cum ms"))
+    for name, m in list(report["imports"].items())[:top]:
+        old = old_imports.get(name, {})
+        print("%-28s %10s %10s%s" % (name, m["self_ms"], m["cumulative_ms"],
+                                     delta(m["cumulative_ms"], old.get("cumulative_ms"))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart home startup-time benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="重复次数（结果取中位数）")
+    parser.add_argument("--timeout", type=float, default=30.0, help="等待 /ready 的最长时间（秒）")
+    parser.add_argument("--top", type=int, default=15, help="打印导入最慢的前 N 个模块")
+    parser.add_argument("--output", help="结果 JSON 路径（默认 bench_results/startup-<时间>.json）")
+    parser.add_argument("--compare", help="与之前保存的结果 JSON 对比")
+    args = parser.parse_args()
+
+    report = run(args)
+    output = args.output or os.path.join(
+        BASE_DIR, "bench_results", "startup-%s.json" % time.strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline, args.top)
+    print("saved:", output)
+
+
+if __name__ == "__main__":
+    main()
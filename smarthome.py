@@ -1,96 +1,2339 @@
 # ================================================================
 
+import sys
 import time
-import board
-import adafruit_dht
-import RPi.GPIO as GPIO
-from flask import Flask, jsonify, render_template_string, request, send_file
+import math
+import random
+from flask import Flask, Response, jsonify, render_template_string, request
 import threading
-import qrcode
 import io
+import json
+import os
+import atexit
+import sqlite3
+import gzip
+import hashlib
+import heapq
+import itertools
+import socket
+import bisect
+import hmac
+import glob
+import datetime
+from collections import namedtuple, deque, OrderedDict
+from array import array
+from concurrent.futures import ThreadPoolExecutor, Future
+
+try:
+    import brotli   # 可选：安装了就额外提供 br 压缩
+except ImportError:
+    brotli = None
+
+try:
+    from flask_sock import Sock, ConnectionClosed   # 可选：线程模式下的 WebSocket /ws
+except ImportError:
+    Sock = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # ================================================================
-# GPIO 设置
+# 运行指标（/metrics，Prometheus 文本格式）
 # ================================================================
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
+# 所有计数器启动时预先分配好，热路径上只做一次 list / dict 元素自增，不加锁；
+# GIL 下极少数并发自增可能丢一次计数，对监控来说可以接受
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
 
-# 灯光引脚
+
+class Histogram:
+    # counts[i] 是落在 (buckets[i-1], buckets[i]] 的次数，最后一格是 +Inf
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+metrics = {
+    "dht_attempts": 0,     # 读取传感器次数
+    "dht_failures": 0,     # RuntimeError（校验失败等，正常现象）
+    "dht_errors": 0,       # 其他异常
+    "dht_retries": 0,      # 上一次失败之后的重读
+    "temp_fallback": 0,    # /api/temp 返回 fallback 值的次数
+    "sse_streams": 0,      # 线程模式下打开着的 /events 连接
+}
+
+# ================================================================
+# 请求追踪（Server-Timing）与采样分析器
+# ================================================================
+# 关闭时 span() 返回同一个空对象，热路径上只多一次全局变量判断；
+# 打开后（SMARTHOME_TRACE=1 或 POST /admin/trace）每个 span 计入全局统计，
+# 请求线程里的 span 还会通过 Server-Timing 响应头返回给浏览器
+tracing = os.environ.get("SMARTHOME_TRACE") == "1"
+trace_local = threading.local()
+trace_lock = threading.Lock()
+span_stats = {}   # span 名 -> [次数, 总耗时, 最大耗时]
+
+
+class Span:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        with trace_lock:
+            st = span_stats.get(self.name)
+            if st is None:
+                st = span_stats[self.name] = [0, 0.0, 0.0]
+            st[0] += 1
+            st[1] += elapsed
+            if elapsed > st[2]:
+                st[2] = elapsed
+        spans = getattr(trace_local, "spans", None)
+        if spans is not None:
+            spans.append((self.name, elapsed))
+
+
+class NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def span(name):
+    return Span(name) if tracing else NO_SPAN
+
+# ================================================================
+# 启动过程：各子系统就绪状态（/ready）
+# ================================================================
+# 导入模块时只做服务网页和 /state 必需的事情，然后马上开始监听端口；
+# 硬件初始化、传感器驱动、历史回填、二维码库等都在后台线程里完成。
+# boot_steps 记录导入期间每一步的耗时，ready_at 记录各子系统就绪的时间
+BOOT_STARTED = time.monotonic()
+SUBSYSTEMS = ("http", "hardware", "sensors", "history", "monitor", "qrcode", "assets")
+
+boot_steps = {}                            # 步骤 -> 耗时（秒）
+ready_at = {name: None for name in SUBSYSTEMS}   # 子系统 -> 启动后多少秒就绪
+ready_errors = {}
+
+
+class BootStep:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        boot_steps[self.name] = round(time.perf_counter() - self.started, 4)
+
+
+def mark_ready(name, error=None):
+    if error is not None:
+        ready_errors[name] = str(error)
+        print("[STARTUP ERROR]", name, error, flush=True)
+        return
+    ready_errors.pop(name, None)
+    if ready_at[name] is None:
+        ready_at[name] = round(time.monotonic() - BOOT_STARTED, 3)
+
+# ================================================================
+# 硬件抽象层：真实树莓派 / 进程内模拟器
+# ================================================================
+# 其余代码只通过 hw 访问硬件（数字输出、温湿度传感器、CPU 温度），
+# 设置 SMARTHOME_BACKEND=sim 就能在普通 Linux 电脑上运行、压测网页和控制逻辑
+BACKEND = os.environ.get("SMARTHOME_BACKEND", "pi")
+
+# 模拟器参数
+SIM_LATENCY = float(os.environ.get("SMARTHOME_SIM_LATENCY", "0.02"))        # 传感器读取耗时（秒）
+SIM_GPIO_LATENCY = float(os.environ.get("SMARTHOME_SIM_GPIO_LATENCY", "0"))  # 每次 GPIO 写入耗时（秒）
+SIM_FAILURE_RATE = float(os.environ.get("SMARTHOME_SIM_FAILURE_RATE", "0.1"))  # 读取失败概率
+SIM_NOISE = float(os.environ.get("SMARTHOME_SIM_NOISE", "0.2"))             # 读数噪声（标准差）
+
+THERMAL_ZONES_GLOB = "/sys/class/thermal/thermal_zone*"
+CPU_FREQ_GLOB = "/sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq"
+THROTTLED_PATH = "/sys/devices/platform/soc/soc:firmware/get_throttled"   # 树莓派固件（十六进制）
+LOADAVG_PATH = "/proc/loadavg"
+
+# I2C GPIO 扩展芯片：型号 -> 通道数
+EXPANDER_CHANNELS = {"mcp23017": 16, "pcf8574": 8}
+MCP23017_IODIRA = 0x00   # IODIRA / IODIRB 连续，一次块写入设置两个端口
+MCP23017_OLATA = 0x14    # OLATA / OLATB 连续，一次块写入写完 16 路
+
+
+class DHTSensor:
+    # adafruit_dht 的包装（DHT22 / DHT11）：read() 返回 (温度, 湿度)，偶发失败时抛 RuntimeError
+
+    def __init__(self, kind, pin):
+        import board
+        import adafruit_dht
+        cls = getattr(adafruit_dht, kind.upper())
+        self.dev = cls(getattr(board, "D%d" % pin), use_pulseio=False)
+
+    def read(self):
+        return self.dev.temperature, self.dev.humidity
+
+
+class RaspberryPiBackend:
+    name = "pi"
+
+    def start(self):
+        # 在硬件线程里调用：导入 RPi.GPIO 比较慢，不放在模块导入阶段
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+
+    def setup_outputs(self, pins):
+        # 设置为输出并默认关闭
+        for pin in pins:
+            self.GPIO.setup(pin, self.GPIO.OUT)
+            self.GPIO.output(pin, self.GPIO.LOW)
+
+    def write(self, pins, values):
+        # pins / values 是等长列表，一次调用写完
+        self.GPIO.output(list(pins), [self.GPIO.HIGH if v else self.GPIO.LOW for v in values])
+
+    def open_sensor(self, kind, pin):
+        return DHTSensor(kind, pin)
+
+    def open_system(self):
+        return SysfsSystemSource()
+
+    def open_expander(self, chip, bus, address):
+        return I2CExpander(chip, bus, address)
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+class SimulatedDHT:
+
+    def __init__(self, backend, pin):
+        self.backend = backend
+        self.pin = pin
+
+    def read(self):
+        b = self.backend
+        if b.latency:
+            time.sleep(b.latency)
+        if random.random() < b.failure_rate:
+            raise RuntimeError("Checksum did not validate. Try again.")
+        # 一天一个周期的温度曲线 + 高斯噪声；不同引脚（房间）有固定偏移
+        phase = math.sin(time.time() / 86400 * 2 * math.pi)
+        return (24.0 + (self.pin % 5) * 0.5 + 3.0 * phase + random.gauss(0, b.noise),
+                50.0 - 8.0 * phase + random.gauss(0, b.noise * 5))
+
+
+class SimulatedBackend:
+    name = "sim"
+
+    def __init__(self, latency=SIM_LATENCY, gpio_latency=SIM_GPIO_LATENCY,
+                 failure_rate=SIM_FAILURE_RATE, noise=SIM_NOISE):
+        self.latency = latency
+        self.gpio_latency = gpio_latency
+        self.failure_rate = failure_rate
+        self.noise = noise
+        self.pins = {}    # 引脚 -> 当前电平（True / False）
+        self.writes = 0
+
+    def start(self):
+        pass
+
+    def setup_outputs(self, pins):
+        for pin in pins:
+            self.pins[pin] = False
+
+    def write(self, pins, values):
+        if self.gpio_latency:
+            time.sleep(self.gpio_latency)
+        for pin, v in zip(pins, values):
+            self.pins[pin] = bool(v)
+        self.writes += 1
+
+    def open_sensor(self, kind, pin):
+        return SimulatedDHT(self, pin)
+
+    def open_system(self):
+        return SimulatedSystemSource(self)
+
+    def open_expander(self, chip, bus, address):
+        return SimulatedExpander(self, chip, address)
+
+    def cleanup(self):
+        pass
+
+
+class I2CExpander:
+    # write_port(value)：一次 I2C 事务写整个端口，value 的第 n 位对应通道 n（需要 smbus2）
+
+    def __init__(self, chip, bus, address):
+        from smbus2 import SMBus
+        self.chip = chip
+        self.address = address
+        self.bus = SMBus(bus)
+        if chip == "mcp23017":
+            self.bus.write_i2c_block_data(address, MCP23017_IODIRA, [0x00, 0x00])   # 全部设为输出
+        self.write_port(0)
+
+    def write_port(self, value):
+        if self.chip == "mcp23017":
+            self.bus.write_i2c_block_data(self.address, MCP23017_OLATA,
+                                          [value & 0xFF, (value >> 8) & 0xFF])
+        else:
+            self.bus.write_byte(self.address, value & 0xFF)
+
+
+class SimulatedExpander:
+
+    def __init__(self, backend, chip, address):
+        self.backend = backend
+        self.chip = chip
+        self.address = address
+        self.port = 0
+        self.writes = 0
+
+    def write_port(self, value):
+        if self.backend.gpio_latency:
+            time.sleep(self.backend.gpio_latency)
+        self.port = value
+        self.writes += 1
+
+
+class SysfsFile:
+    # 打开一次，之后每次用 pread 从偏移 0 重新读取，不再 open / close
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read(self):
+        return os.pread(self.fd, 256, 0).decode("ascii", "replace").strip()
+
+
+def open_sysfs(path):
+    try:
+        return SysfsFile(path)
+    except OSError:
+        return None
+
+
+def sysfs_sort_key(path):
+    # thermal_zone10 排在 thermal_zone2 后面
+    digits = "".join(c if c.isdigit() else " " for c in path).split()
+    return [int(d) for d in digits], path
+
+
+class SysfsSystemSource:
+    # read() 返回 {"zones": [...], "freq_mhz": [...], "throttled": int/None, "load": [...]}
+
+    def __init__(self):
+        self.zones = []   # (zone 名, 类型, SysfsFile)
+        for zone in sorted(glob.glob(THERMAL_ZONES_GLOB), key=sysfs_sort_key):
+            temp = open_sysfs(zone + "/temp")
+            if temp is None:
+                continue
+            kind = open_sysfs(zone + "/type")
+            self.zones.append((os.path.basename(zone), kind.read() if kind else "", temp))
+        self.freqs = [f for f in map(open_sysfs, sorted(glob.glob(CPU_FREQ_GLOB), key=sysfs_sort_key))
+                      if f is not None]
+        self.throttled = open_sysfs(THROTTLED_PATH)
+        self.loadavg = open_sysfs(LOADAVG_PATH)
+
+    def read(self):
+        zones = []
+        for name, kind, f in self.zones:
+            try:
+                zones.append({"zone": name, "type": kind, "temp": round(int(f.read()) / 1000, 1)})
+            except (OSError, ValueError):
+                pass
+        freqs = []
+        for f in self.freqs:
+            try:
+                freqs.append(int(f.read()) // 1000)
+            except (OSError, ValueError):
+                pass
+        throttled = load = None
+        try:
+            if self.throttled is not None:
+                throttled = int(self.throttled.read(), 16)
+            if self.loadavg is not None:
+                load = [float(x) for x in self.loadavg.read().split()[:3]]
+        except (OSError, ValueError):
+            pass
+        return {"zones": zones, "freq_mhz": freqs, "throttled": throttled, "load": load}
+
+
+class SimulatedSystemSource:
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def read(self):
+        temp = round(45.0 + random.gauss(0, self.backend.noise * 5), 1)
+        return {
+            "zones": [{"zone": "thermal_zone0", "type": "cpu-thermal", "temp": temp}],
+            "freq_mhz": [1500] * 4,
+            "throttled": 0,
+            "load": [round(random.uniform(0.1, 0.6), 2) for _ in range(3)],
+        }
+
+
+BACKENDS = {"pi": RaspberryPiBackend, "sim": SimulatedBackend}
+
+hw = BACKENDS[BACKEND]()
+
+# ================================================================
+# 硬件 I/O 线程：所有 GPIO / I2C 写入和传感器读取都在这一个线程里串行执行
+# ================================================================
+# 写入只记录“每个引脚 / 端口的最终电平”，线程下一次刷新时一次写完：
+# 刷新之前同一个引脚被改了好几次，只会写最后一次；请求线程改完状态就返回，
+# 不等硬件。需要结果的操作排进有界队列，队列满时调用方等待。
+# 读传感器单独一条线程：DHT22 在树莓派上 bit-bang 一次约 0.35 秒，和写入放在同一条线程里时
+# 按钮要排在它后面，报警闪烁 0.1 秒一步的亮 / 灭也会被合并成一次写入。传感器引脚和输出引脚
+# 不重叠，RPi.GPIO 按引脚写置位 / 清零寄存器，两条线程同时操作不同引脚互不影响
+HW_QUEUE_SIZE = 64
+
+gpio_writes = {}   # 引脚 -> 写入次数（setup_outputs 之后预先分配）
+
+
+class HardwareWorker:
+
+    def __init__(self, maxsize):
+        self.cond = threading.Condition()
+        self.maxsize = maxsize
+        self.pins = {}    # 引脚 -> 待写电平
+        self.ports = {}   # ExpanderPort -> 待写端口值
+        self.jobs = deque()   # (函数, Future)
+        self.reads = deque()  # 传感器读取 (函数, Future)，由传感器线程执行
+        self.initialized = threading.Event()
+        self.submitted = 0    # 提交的写入（引脚 / 端口）次数
+        self.coalesced = 0    # 被后一次写入覆盖、没有真正写出去的次数
+        self.errors = 0
+        self.max_depth = 0
+        self.service = Histogram()        # 每批处理耗时
+        self.read_service = Histogram()   # 每次传感器读取耗时
+
+    def start(self, init):
+        # init() 在硬件线程里最先执行；在那之前提交的写入先排队合并，不会提前写到引脚上
+        threading.Thread(target=self.run, args=(init,), name="hardware", daemon=True).start()
+        threading.Thread(target=self.run_reads, name="hardware-sensors", daemon=True).start()
+
+    def depth(self):
+        return len(self.pins) + len(self.ports) + len(self.jobs) + len(self.reads)
+
+    def write_pins(self, pins, values):
+        with self.cond:
+            for pin, value in zip(pins, values):
+                if pin in self.pins:
+                    self.coalesced += 1
+                self.pins[pin] = value
+            self.submitted += len(pins)
+            self.wake()
+
+    def write_port(self, port, value):
+        with self.cond:
+            if port in self.ports:
+                self.coalesced += 1
+            self.ports[port] = value
+            self.submitted += 1
+            self.wake()
+
+    def call(self, fn):
+        # 在硬件线程里执行 fn() 并等待结果；异常原样抛给调用方
+        return self.submit(self.jobs, fn)
+
+    def read(self, fn):
+        # 在传感器线程里执行 fn() 并等待结果，不挡住写入
+        return self.submit(self.reads, fn)
+
+    def submit(self, queue, fn):
+        future = Future()
+        with self.cond:
+            while len(queue) >= self.maxsize:
+                self.cond.wait()
+            queue.append((fn, future))
+            self.wake()
+        return future.result()
+
+    def wake(self):
+        self.max_depth = max(self.max_depth, self.depth())
+        self.cond.notify_all()
+
+    def run(self, init):
+        try:
+            init()
+            mark_ready("hardware")
+        except Exception as e:
+            mark_ready("hardware", e)
+        self.initialized.set()
+        while True:
+            with self.cond:
+                while not (self.pins or self.ports or self.jobs):
+                    self.cond.wait()
+                pins, self.pins = self.pins, {}
+                ports, self.ports = self.ports, {}
+                jobs, self.jobs = self.jobs, deque()
+                self.cond.notify_all()   # 队列空出来了，唤醒等待的 call()
+
+            started = time.perf_counter()
+            # 先写（同一批里的写入都发生在这些任务提交之前），再执行任务
+            if pins:
+                try:
+                    with span("gpio"):
+                        hw.write(list(pins), list(pins.values()))
+                    for pin in pins:
+                        gpio_writes[pin] += 1
+                except Exception as e:
+                    self.errors += 1
+                    print("[HW ERROR]", e, flush=True)
+            for port, value in ports.items():
+                try:
+                    with span("i2c"):
+                        port.driver.write_port(value)
+                    port.writes += 1
+                except Exception as e:
+                    self.errors += 1
+                    print("[HW ERROR]", port.name, e, flush=True)
+            for fn, future in jobs:
+                try:
+                    future.set_result(fn())
+                except BaseException as e:
+                    future.set_exception(e)
+            self.service.observe(time.perf_counter() - started)
+
+    def run_reads(self):
+        self.initialized.wait()   # 硬件初始化之后才能打开传感器
+        while True:
+            with self.cond:
+                while not self.reads:
+                    self.cond.wait()
+                fn, future = self.reads.popleft()
+                self.cond.notify_all()   # 唤醒等待的 read()
+
+            started = time.perf_counter()
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+            self.read_service.observe(time.perf_counter() - started)
+
+
+worker = HardwareWorker(HW_QUEUE_SIZE)
+
+
+def gpio_write(pins, values):
+    # 所有数字输出都从这里走：交给硬件线程合并写入
+    worker.write_pins(pins, values)
+
+# ================================================================
+# 设备注册表（devices.json）：灯 / 继电器、分组、模式
+# ================================================================
+# 每个设备占状态位图里的一位，模式（例如夜间模式）排在设备后面；
+# 命令在加载配置时就编译成 (置位掩码, 清位掩码)，执行命令只是查表 + 位运算，
+# 分组开关也只是一个预先算好的掩码。接在 I2C 扩展芯片上的设备按端口合并，
+# 一次命令里同一端口上的所有变化只写一次
+DEVICES_PATH = os.environ.get("SMARTHOME_DEVICES", os.path.join(BASE_DIR, "devices.json"))
+
+# 默认配置：三路灯直接接在树莓派 GPIO 上
 PIN_MAIN = 18
 PIN_BEDROOM = 17
 PIN_HALL = 27
 
-# 设置为输出并默认关闭
-for pin in [PIN_MAIN, PIN_BEDROOM, PIN_HALL]:
-    GPIO.setup(pin, GPIO.OUT)
-    GPIO.output(pin, GPIO.LOW)
-
-device_states = {
-    "main": False,
-    "bedroom": False,
-    "hall": False,
-    "night":False,
-    "all":False
+DEFAULT_DEVICES = {
+    "expanders": [],
+    "devices": [
+        # watts：额定功率，用来估算耗电量（/api/usage），不填则只统计开灯时长
+        {"name": "main", "kind": "light", "pin": PIN_MAIN, "groups": ["all"], "watts": 12},
+        {"name": "bedroom", "kind": "light", "pin": PIN_BEDROOM, "groups": ["all"], "watts": 9},
+        {"name": "hall", "kind": "light", "pin": PIN_HALL, "groups": ["all"], "watts": 5},
+    ],
+    # 模式 -> 开启时唯一亮着的设备（夜间模式：只亮走廊灯）
+    "modes": {"night": ["hall"]},
+    # 场景：一组按顺序执行的命令（例如 “I am home”）
+    "scenes": {"home": ["all_on"], "leaving": ["all_off"], "sleep": ["night_on"]},
+    "alarm_blink": "hall",   # 报警时闪烁的设备，null 表示不闪
 }
 
+Device = namedtuple("Device", ["name", "kind", "bit", "pin", "expander", "channel", "watts"])
+
+# test 为 None：普通命令；否则是切换命令，状态里 test 的位全部为 1 时改用 otherwise
+Command = namedtuple("Command", ["set", "clear", "test", "otherwise"])
+
+
+def iter_bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def apply_command(state, cmd):
+    if cmd.test is not None and state & cmd.test == cmd.test:
+        cmd = cmd.otherwise
+    return (state & ~cmd.clear) | cmd.set
+
+
+class ExpanderPort:
+    # 一个扩展芯片：保存端口的影子值，只在值变化时写一次
+
+    def __init__(self, name, chip, bus, address, channels):
+        self.name = name
+        self.chip = chip
+        self.bus = bus
+        self.address = address
+        self.driver = None   # 硬件线程初始化时才打开
+        self.channels = channels
+        self.port = 0
+        self.devmask = 0        # 接在这个芯片上的设备位
+        self.channel_bits = {}  # 设备位 -> 通道掩码
+        self.writes = 0
+
+    def apply(self, changed, levels):
+        port = self.port
+        for bit in iter_bits(changed & self.devmask):
+            ch = self.channel_bits[bit]
+            port = port | ch if levels >> bit & 1 else port & ~ch
+        if port != self.port:
+            worker.write_port(self, port)
+            self.port = port
+
+
+class DeviceRegistry:
+
+    def __init__(self, config):
+        self.devices = {}    # 名称 -> Device
+        self.pins = []       # 设备位 -> GPIO 引脚（扩展芯片上的设备为 None）
+        self.ports = {}      # 扩展芯片 id -> ExpanderPort
+        self.groups = {}     # 分组名 -> 设备掩码
+        self.modes = {}      # 模式名 -> 模式位
+        self.native_mask = 0
+
+        for conf in config.get("expanders", []):
+            chip = conf.get("chip", "mcp23017")
+            if chip not in EXPANDER_CHANNELS:
+                raise ValueError("unknown expander chip: %s" % chip)
+            address = conf["address"]
+            if isinstance(address, str):
+                address = int(address, 0)   # 允许写成 "0x20"
+            self.ports[conf["id"]] = ExpanderPort(conf["id"], chip, int(conf.get("bus", 1)), address,
+                                                  EXPANDER_CHANNELS[chip])
+
+        for conf in config["devices"]:
+            name = conf["name"]
+            if name in self.devices:
+                raise ValueError("duplicate device: %s" % name)
+            bit = len(self.pins)
+            watts = float(conf["watts"]) if conf.get("watts") is not None else None
+            if "expander" in conf:
+                port = self.ports[conf["expander"]]
+                channel = int(conf["channel"])
+                if not 0 <= channel < port.channels or (1 << channel) in port.channel_bits.values():
+                    raise ValueError("bad or duplicate channel for %s" % name)
+                port.devmask |= 1 << bit
+                port.channel_bits[bit] = 1 << channel
+                device = Device(name, conf.get("kind", "light"), bit, None, conf["expander"], channel, watts)
+            else:
+                device = Device(name, conf.get("kind", "light"), bit, int(conf["pin"]), None, None, watts)
+                self.native_mask |= 1 << bit
+            self.devices[name] = device
+            self.pins.append(device.pin)
+            for group in conf.get("groups", []):
+                self.groups[group] = self.groups.get(group, 0) | 1 << bit
+        self.device_mask = (1 << len(self.pins)) - 1
+
+        mode_on = {}
+        for name, members in config.get("modes", {}).items():
+            self.modes[name] = 1 << (len(self.pins) + len(self.modes))
+            mode_on[name] = self.mask_of(members)
+
+        names = list(self.devices) + list(self.groups) + list(self.modes)
+        if len(set(names)) != len(names):
+            raise ValueError("device, group and mode names must be unique")
+
+        # 编译命令表
+        self.commands = {}
+        for name, device in self.devices.items():
+            self.add_switch(name, 1 << device.bit, 0)
+        for name, mask in self.groups.items():
+            # “all” 全开时顺带退出所有模式（和以前 all_on 关掉夜间模式一致）
+            self.add_switch(name, mask, sum(self.modes.values()) if name == "all" else 0)
+        for name, bit in self.modes.items():
+            on = Command(bit | mode_on[name], self.device_mask, None, None)
+            off = Command(0, bit | mode_on[name], None, None)
+            self.add_toggle(name, on, off, bit)
+
+        self.scenes = config.get("scenes", {})
+        for scene, cmds in self.scenes.items():
+            unknown = [c for c in cmds if c not in self.commands]
+            if unknown:
+                raise ValueError("scene %s: unknown command %s" % (scene, ", ".join(unknown)))
+        self.alarm_blink = config.get("alarm_blink")
+        if self.alarm_blink is not None and self.alarm_blink not in self.devices:
+            raise ValueError("alarm_blink: unknown device %s" % self.alarm_blink)
+
+        self.native_pins = [p for p in self.pins if p is not None]
+        gpio_writes.update({pin: 0 for pin in self.native_pins})
+
+    def open_hardware(self):
+        # 在硬件线程里执行：设置输出引脚、打开扩展芯片
+        hw.setup_outputs(self.native_pins)
+        for port in self.ports.values():
+            port.driver = hw.open_expander(port.chip, port.bus, port.address)
+
+    def mask_of(self, names):
+        return sum(1 << self.devices[n].bit for n in names)
+
+    def add_switch(self, name, mask, ends_modes):
+        on = Command(mask, ends_modes, None, None)
+        off = Command(0, mask, None, None)
+        self.add_toggle(name, on, off, mask)
+
+    def add_toggle(self, name, on, off, test):
+        self.commands[name + "_on"] = on
+        self.commands[name + "_off"] = off
+        self.commands["toggle_" + name] = Command(on.set, on.clear, test, off)
+
+    def write(self, changed, levels):
+        # 把 changed 里的设备写成 levels 中对应位的电平：
+        # 直接接 GPIO 的设备一次 gpio_write，每个扩展芯片一次端口写入
+        native = changed & self.native_mask
+        if native:
+            bits = list(iter_bits(native))
+            gpio_write([self.pins[b] for b in bits], [bool(levels >> b & 1) for b in bits])
+        for port in self.ports.values():
+            if changed & port.devmask:
+                port.apply(changed, levels)
+
+    def states(self, mask):
+        out = {name: bool(mask >> d.bit & 1) for name, d in self.devices.items()}
+        out.update({name: bool(mask & bit) for name, bit in self.modes.items()})
+        # 分组：全部打开才算开
+        out.update({name: mask & m == m for name, m in self.groups.items()})
+        return out
+
+
+def load_devices(path):
+    if not os.path.exists(path):
+        return DEFAULT_DEVICES
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+with BootStep("registry"):
+    registry = DeviceRegistry(load_devices(DEVICES_PATH))
+
+
+def hardware_init():
+    hw.start()
+    registry.open_hardware()
+
+
+worker.start(hardware_init)
+
+state_mask = 0   # 设备位 + 模式位，只在 state_lock 里修改
+device_states = registry.states(state_mask)
+
+# ================================================================
+# 事件推送中心（SSE /events 使用）
+# ================================================================
+# 每个事件都有单调递增的编号（也就是 SSE 的 id），最近 EVENT_BACKLOG 条保存在
+# 内存里，浏览器断线重连时带上 Last-Event-ID 就能补齐错过的事件
+EVENT_BACKLOG = 256
+
+state_version = 0   # 灯光状态每变化一次加 1
+
+
+def dump_json(data):
+    # 紧凑格式，减少手机流量
+    return json.dumps(data, separators=(",", ":"))
+
+
+class EventHub:
+
+    def __init__(self, backlog):
+        self.cond = threading.Condition()
+        self.events = deque(maxlen=backlog)   # (seq, kind, json)
+        self.seq = 0
+        self.listeners = set()   # 异步模式的订阅者：有新事件时调用（不能阻塞）
+
+    def publish(self, kind, data):
+        payload = dump_json(data)
+        with self.cond:
+            self.seq += 1
+            self.events.append((self.seq, kind, payload))
+            self.cond.notify_all()
+            for notify in self.listeners:
+                notify()
+            return self.seq
+
+    def since(self, seq):
+        # 返回 seq 之后的事件；如果中间有事件已经被挤出缓冲区返回 None
+        with self.cond:
+            if seq > self.seq:
+                return None
+            if seq == self.seq:
+                return []
+            if not self.events or self.events[0][0] > seq + 1:
+                return None
+            return [e for e in self.events if e[0] > seq]
+
+    def wait(self, seq, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > seq, timeout)
+        return self.since(seq)
+
+
+hub = EventHub(EVENT_BACKLOG)
+
+
+def state_payload():
+    return dict(device_states, version=state_version)
+
+
+def publish_state():
+    # 每次修改 device_states 之后调用：版本号加 1 并推送给所有客户端
+    global state_version
+    with hub.cond:
+        state_version += 1
+        hub.publish("state", state_payload())
+
 # ================================================================
-# DHT22 初始化
+# 灯光命令：统一在 state_lock 下原子执行
 # ================================================================
-dht = adafruit_dht.DHT22(board.D4, use_pulseio=False)
+# 所有修改 device_states 的地方都走 run_commands()：先在副本上算出最终状态，
+# 再一次性写 GPIO、更新状态、推送一次版本号，多个请求并发也不会交错
+state_lock = threading.RLock()
+
+# 命令名 -> Command：<设备|分组|模式>_on / _off / toggle_<...>，由设备注册表生成
+COMMANDS = registry.commands
+SCENES = registry.scenes
+
+
+def run_commands(cmds, source=None):
+    global state_mask
+    # 有任何一条未知命令就整体拒绝，不做任何修改
+    unknown = [c for c in cmds if c not in COMMANDS]
+    if unknown:
+        raise ValueError("unknown command: " + ", ".join(unknown))
+    ops = [COMMANDS[c] for c in cmds]
+
+    with state_lock:
+        new = state_mask
+        for op in ops:
+            new = apply_command(new, op)
+
+        # 只写真正变化的设备：GPIO 一次调用，每个扩展芯片一次端口写入
+        changed = (new ^ state_mask) & registry.device_mask
+        if changed:
+            registry.write(changed, new)
+
+        new_states = registry.states(new)
+        changed_states = [name for name in new_states if new_states[name] != device_states[name]]
+        state_mask = new
+        device_states.update(new_states)
+        publish_state()
+        # 分组状态由设备推出来，不记日志
+        detail = ",".join(cmds)
+        for name in changed_states:
+            if name in registry.devices:
+                usage.switch(name, new_states[name])
+            if name in registry.devices or name in registry.modes:
+                journal.record("state", name, new_states[name], source, detail)
+        if changed_states:
+            rules.on_state(changed_states, device_states)
+        return state_payload()
+
+# ================================================================
+# 定时调度器：所有定时任务共用一个线程
+# ================================================================
+class Scheduler:
+    # heapq 保存 [到期时间, 序号, 回调]；取消时只把回调置空，到期后直接丢弃
+
+    def __init__(self):
+        self.heap = []
+        self.cond = threading.Condition()
+        self.counter = itertools.count()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def call_later(self, delay, fn):
+        task = [time.monotonic() + delay, next(self.counter), fn]
+        with self.cond:
+            heapq.heappush(self.heap, task)
+            self.cond.notify()
+        return task
+
+    def cancel(self, task):
+        task[2] = None
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        task = heapq.heappop(self.heap)
+                        break
+                    self.cond.wait(delay)
+            fn = task[2]
+            if fn is not None:
+                try:
+                    fn()
+                except Exception as e:
+                    print("[SCHEDULER ERROR]", e, flush=True)
+
+
+scheduler = Scheduler()
 
-# 温湿度历史记录（用于折线图）
-history_temp = []
-history_humi = []
 
 # ================================================================
-# 温度报警线程（后台运行）
+# LED 闪烁模式（由调度器驱动，不占用睡眠线程）
 # ================================================================
-import threading
+class LedPattern:
+    # steps: [(电平, 持续秒数), ...]；每轮结束后恢复用户通过 device_states 设置的状态，
+    # 间隔 repeat 秒再来一轮，直到 stop()；repeat 为 None 时只闪一轮
+
+    def __init__(self, device, steps, repeat):
+        self.device = device
+        self.bit = 1 << registry.devices[device].bit
+        self.steps = steps
+        self.repeat = repeat
+        self.running = False
+        self.task = None
+
+    def start(self):
+        with state_lock:
+            if not self.running:
+                self.running = True
+                self.step(0)
+
+    def stop(self):
+        with state_lock:
+            if self.running:
+                self.running = False
+                if self.task is not None:
+                    scheduler.cancel(self.task)
+                    self.task = None
+                self.restore()
+
+    def step(self, i):
+        with state_lock:
+            if not self.running:
+                return
+            if i < len(self.steps):
+                level, duration = self.steps[i]
+                registry.write(self.bit, self.bit if level else 0)
+                self.task = scheduler.call_later(duration, lambda: self.step(i + 1))
+            else:
+                self.restore()
+                if self.repeat is None:   # 一次性闪烁
+                    self.running = False
+                    self.task = None
+                else:
+                    self.task = scheduler.call_later(self.repeat, lambda: self.step(0))
 
-ALARM_TEMP = 31.0     # 31°C 以上触发报警
-alarm_active = False
+    def restore(self):
+        registry.write(self.bit, state_mask)
 
+# ================================================================
+# 温湿度传感器配置（多房间，sensors.json）
+# ================================================================
+# [{"id": "living", "room": "Living Room", "kind": "dht22", "pin": 4, "interval": 5}, ...]
+# 第一个传感器是主传感器：首页温度、报警、自动化规则和 /api/history 默认都用它
+SENSORS_PATH = os.environ.get("SMARTHOME_SENSORS", os.path.join(BASE_DIR, "sensors.json"))
+
+DHT_PIN = 4   # 默认：一个 DHT22，DATA 接 GPIO4
+DEFAULT_SENSORS = [{"id": "main", "room": "Home", "kind": "dht22", "pin": DHT_PIN}]
+
+# 各型号两次读取之间的最短间隔（秒）
+SENSOR_MIN_INTERVAL = {"dht22": 2.0, "dht11": 1.0}
+
+
+class SensorSlot:
+    # 一个传感器的配置、设备对象和最新样本（整体替换，读取方不加锁）
+
+    def __init__(self, conf, primary):
+        self.id = str(conf["id"])
+        self.room = conf.get("room", self.id)
+        self.kind = conf.get("kind", "dht22")
+        self.pin = int(conf["pin"])
+        self.interval = max(float(conf.get("interval", 0)), SENSOR_MIN_INTERVAL[self.kind])
+        self.primary = primary
+        self.prefix = "" if primary else self.id + "."   # 数据库序列名前缀
+        self.dev = None   # 采样线程第一次读取时才打开（会导入传感器驱动）
+        self.latest = None
+        self.seq = 0
+        self.failed = False
+        self.last_history_ts = 0.0
+
+
+def load_sensors(path):
+    confs = DEFAULT_SENSORS
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            confs = json.load(f)
+    out = []
+    for conf in confs:
+        try:
+            out.append(SensorSlot(conf, not out))
+        except (KeyError, ValueError, TypeError) as e:
+            print("[SENSOR ERROR] skip %r: %s" % (conf.get("id") if isinstance(conf, dict) else conf, e),
+                  flush=True)
+    if not out:
+        # 一个能用的都没有时退回默认传感器：采样线程、首页和 /api/history 都要有主传感器
+        print("[SENSOR ERROR] no usable sensor in %s, using the default" % path, flush=True)
+        out = [SensorSlot(conf, not i) for i, conf in enumerate(DEFAULT_SENSORS)]
+    if len({s.id for s in out}) != len(out):
+        raise ValueError("duplicate sensor id in " + path)
+    return out
+
+
+with BootStep("sensors"):
+    sensors = load_sensors(SENSORS_PATH)
+sensors_by_id = {s.id: s for s in sensors}
+
+# ================================================================
+# 温湿度历史记录（用于折线图）：定长环形缓冲区
+# ================================================================
+HISTORY_INTERVAL = 10.0              # 每 10 秒记录一个历史点
+HISTORY_CAPACITY = 7 * 24 * 360      # 保存 7 天，约 60480 点 / 1.5 MB
+
+
+class RingBuffer:
+    # 三个 array('d') 平行存放时间戳 / 温度 / 湿度，不为每个样本创建 dict
+    # 写满之后覆盖最旧的数据，长期运行内存也不会增长
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ts = array("d", bytes(8 * capacity))
+        self.temp = array("d", bytes(8 * capacity))
+        self.hum = array("d", bytes(8 * capacity))
+        self.start = 0    # 最旧样本的物理位置
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, ts, temp, hum):
+        with self.lock:
+            if self.count:
+                # 系统校时往回拨时保持时间戳单调，保证二分查找有效
+                last = self.ts[(self.start + self.count - 1) % self.capacity]
+                ts = max(ts, last)
+            i = (self.start + self.count) % self.capacity
+            self.ts[i] = ts
+            self.temp[i] = temp
+            self.hum[i] = hum
+            if self.count < self.capacity:
+                self.count += 1
+            else:
+                self.start = (self.start + 1) % self.capacity
+
+    def _bisect(self, t, right=False):
+        # 在逻辑顺序上二分查找（调用方持有锁）
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            v = self.ts[(self.start + mid) % self.capacity]
+            if v < t or (right and v == t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _copy(self, column, a, b):
+        # 把逻辑区间 [a, b) 拷贝成连续的 array，最多拼接两段
+        i = (self.start + a) % self.capacity
+        j = i + (b - a)
+        if j <= self.capacity:
+            return column[i:j]
+        return column[i:] + column[:j - self.capacity]
+
+    def oldest(self):
+        with self.lock:
+            return self.ts[self.start] if self.count else None
+
+    def range(self, t0, t1):
+        # 返回 [t0, t1] 内样本的拷贝：(ts, temp, hum)
+        with self.lock:
+            a = self._bisect(t0)
+            b = self._bisect(t1, right=True)
+            return (self._copy(self.ts, a, b),
+                    self._copy(self.temp, a, b),
+                    self._copy(self.hum, a, b))
+
+    def since(self, t, limit):
+        # 时间戳 > t 的样本，最多返回最新的 limit 个：(ts, temp, hum, 是否截断)
+        with self.lock:
+            a = self._bisect(t, right=True)
+            b = self.count
+            truncated = b - a > limit
+            if truncated:
+                a = b - limit
+            return (self._copy(self.ts, a, b),
+                    self._copy(self.temp, a, b),
+                    self._copy(self.hum, a, b),
+                    truncated)
+
+
+def downsample(ts, temp, hum, t0, t1, points):
+    # 把 [t0, t1] 等分成 points 个时间桶，每桶输出 min / max / avg
+    # 空桶直接跳过；样本数不超过 points 时原样返回
+    n = len(ts)
+    if n <= points:
+        return {
+            "ts": [round(x, 1) for x in ts],
+            "temp": list(temp), "temp_min": list(temp), "temp_max": list(temp),
+            "hum": list(hum), "hum_min": list(hum), "hum_max": list(hum),
+        }
+
+    width = (t1 - t0) / points
+    cnt = [0] * points
+    ts_sum = [0.0] * points
+    t_sum = [0.0] * points
+    t_min = [float("inf")] * points
+    t_max = [float("-inf")] * points
+    h_sum = [0.0] * points
+    h_min = [float("inf")] * points
+    h_max = [float("-inf")] * points
+
+    for i in range(n):
+        k = min(int((ts[i] - t0) / width), points - 1)
+        t = temp[i]
+        h = hum[i]
+        cnt[k] += 1
+        ts_sum[k] += ts[i]
+        t_sum[k] += t
+        h_sum[k] += h
+        if t < t_min[k]: t_min[k] = t
+        if t > t_max[k]: t_max[k] = t
+        if h < h_min[k]: h_min[k] = h
+        if h > h_max[k]: h_max[k] = h
+
+    out = {k: [] for k in ("ts", "temp", "temp_min", "temp_max",
+                           "hum", "hum_min", "hum_max")}
+    for k in range(points):
+        c = cnt[k]
+        if not c:
+            continue
+        out["ts"].append(round(ts_sum[k] / c, 1))
+        out["temp"].append(round(t_sum[k] / c, 2))
+        out["temp_min"].append(t_min[k])
+        out["temp_max"].append(t_max[k])
+        out["hum"].append(round(h_sum[k] / c, 2))
+        out["hum_min"].append(h_min[k])
+        out["hum_max"].append(h_max[k])
+    return out
+
+
+history = RingBuffer(HISTORY_CAPACITY)
+
+# ================================================================
+# 持久化时序存储（SQLite WAL 模式）
+# ================================================================
+# 样本先放在内存里，每 DB_FLUSH_INTERVAL 秒一个事务批量写入，减少 SD 卡磨损；
+# 写入时同时增量更新分钟 / 小时 / 天三级汇总，长时间范围查询只读汇总表
+DB_PATH = os.environ.get(
+    "SMARTHOME_DB",
+    os.path.join(BASE_DIR, "smarthome.db")
+)
+DB_FLUSH_INTERVAL = 60.0          # 批量写入间隔（秒）
+DB_MAINTAIN_INTERVAL = 3600.0     # 过期清理 + 压缩间隔（秒）
+DB_MMAP_SIZE = 64 * 1024 * 1024   # 读取走 mmap
+
+RAW_RETENTION = 7 * 86400         # 原始样本保留 7 天（与环形缓冲区一致）
+ROLLUP_RETENTION = {              # 各级汇总的保留时间，None 表示永久保留
+    60: 30 * 86400,
+    3600: 2 * 365 * 86400,
+    86400: None,
+}
+ROLLUP_RESOLUTIONS = tuple(sorted(ROLLUP_RETENTION))
+
+
+class TimeSeriesStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.db_lock = threading.Lock()
+
+        is_new = not os.path.exists(path)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        if is_new:
+            # 必须在建表之前设置，之后才能做增量压缩
+            self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS samples(
+                series TEXT NOT NULL,
+                ts REAL NOT NULL,
+                value REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS samples_series_ts ON samples(series, ts);
+            CREATE TABLE IF NOT EXISTS rollups(
+                series TEXT NOT NULL,
+                res INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                n INTEGER NOT NULL,
+                sum REAL NOT NULL,
+                min REAL NOT NULL,
+                max REAL NOT NULL,
+                PRIMARY KEY(series, res, bucket)
+            ) WITHOUT ROWID;
+        """)
+        self.conn.commit()
+
+    def add(self, series, ts, value):
+        with self.pending_lock:
+            self.pending.append((series, ts, value))
+
+    def flush(self):
+        with self.pending_lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        # 先在内存里把这一批合并成汇总增量，每个桶只 upsert 一次
+        agg = {}
+        for series, ts, value in batch:
+            for res in ROLLUP_RESOLUTIONS:
+                key = (series, res, int(ts // res * res))
+                a = agg.get(key)
+                if a is None:
+                    agg[key] = [1, value, value, value]
+                else:
+                    a[0] += 1
+                    a[1] += value
+                    if value < a[2]: a[2] = value
+                    if value > a[3]: a[3] = value
 
-def alarm_thread():
-    global alarm_active
+        try:
+            with self.db_lock, self.conn:
+                self.conn.executemany(
+                    "INSERT INTO samples(series, ts, value) VALUES (?, ?, ?)", batch)
+                self.conn.executemany("""
+                    INSERT INTO rollups(series, res, bucket, n, sum, min, max)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(series, res, bucket) DO UPDATE SET
+                        n = n + excluded.n,
+                        sum = sum + excluded.sum,
+                        min = MIN(min, excluded.min),
+                        max = MAX(max, excluded.max)
+                """, [k + tuple(v) for k, v in agg.items()])
+        except sqlite3.Error as e:
+            print("[DB ERROR]", e, flush=True)
+
+    def maintain(self):
+        # 删除过期数据，然后增量回收空闲页并截断 WAL
+        now = time.time()
+        try:
+            with self.db_lock:
+                with self.conn:
+                    self.conn.execute("DELETE FROM samples WHERE ts < ?",
+                                      (now - RAW_RETENTION,))
+                    for res, keep in ROLLUP_RETENTION.items():
+                        if keep is not None:
+                            self.conn.execute(
+                                "DELETE FROM rollups WHERE res = ? AND bucket < ?",
+                                (res, now - keep))
+                self.conn.execute("PRAGMA incremental_vacuum")
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            print("[DB ERROR]", e, flush=True)
+
+    def recent_climate(self, since):
+        # 启动时用来回填环形缓冲区：[(ts, temp, hum), ...]
+        query = "SELECT ts, value FROM samples WHERE series = ? AND ts >= ? ORDER BY ts"
+        with self.db_lock:
+            temp = self.conn.execute(query, ("temp", since)).fetchall()
+            hum = dict(self.conn.execute(query, ("hum", since)).fetchall())
+        return [(ts, t, hum[ts]) for ts, t in temp if ts in hum]
+
+    def rollup_buckets(self, series, t0, t1, points):
+        # 选最粗但仍能填满 points 个桶的汇总级别，再在 SQL 里按时间桶合并
+        span = max(t1 - t0, 1.0)
+        res = ROLLUP_RESOLUTIONS[0]
+        for r in reversed(ROLLUP_RESOLUTIONS):
+            if span / r >= points:
+                res = r
+                break
+        width = span / points
+        with self.db_lock:
+            return self.conn.execute("""
+                SELECT CAST((bucket - ?) / ? AS INTEGER) AS k,
+                       SUM(bucket * n) / SUM(n), SUM(sum) / SUM(n), MIN(min), MAX(max)
+                FROM rollups
+                WHERE series = ? AND res = ? AND bucket >= ? AND bucket <= ?
+                GROUP BY k ORDER BY k
+            """, (t0, width, series, res, t0 - res, t1)).fetchall()
+
+    def bucket_sums(self, series, res, since):
+        # 某一级汇总表里每个桶的累加值：[(bucket, sum), ...]，走主键索引
+        with self.db_lock:
+            return self.conn.execute(
+                "SELECT bucket, sum FROM rollups WHERE series = ? AND res = ? AND bucket >= ? ORDER BY bucket",
+                (series, res, since)).fetchall()
+
+    def history(self, t0, t1, points, prefix=""):
+        # 与 downsample() 返回相同的列式结构；prefix 选择其他房间的传感器
+        temp = self.rollup_buckets(prefix + "temp", t0, t1, points)
+        hum = {row[0]: row for row in self.rollup_buckets(prefix + "hum", t0, t1, points)}
+        out = {k: [] for k in ("ts", "temp", "temp_min", "temp_max",
+                               "hum", "hum_min", "hum_max")}
+        for k, ts, avg, lo, hi in temp:
+            h = hum.get(k)
+            if h is None:
+                continue
+            out["ts"].append(round(ts, 1))
+            out["temp"].append(round(avg, 2))
+            out["temp_min"].append(lo)
+            out["temp_max"].append(hi)
+            out["hum"].append(round(h[2], 2))
+            out["hum_min"].append(h[3])
+            out["hum_max"].append(h[4])
+        return out
+
+
+def store_thread():
+    last_maintain = time.monotonic()
     while True:
+        time.sleep(DB_FLUSH_INTERVAL)
+        usage.checkpoint()   # 亮着的灯先把到目前为止的时长记上
+        store.flush()
+        if time.monotonic() - last_maintain >= DB_MAINTAIN_INTERVAL:
+            last_maintain = time.monotonic()
+            store.maintain()
+
+
+with BootStep("store"):
+    store = TimeSeriesStore(DB_PATH)
+
+
+def refill_history():
+    # 重启后用数据库里的原始样本回填环形缓冲区（在采样线程开始读取之前执行）
+    try:
+        for ts, temp, hum in store.recent_climate(time.time() - RAW_RETENTION):
+            history.append(ts, temp, hum)
+        mark_ready("history")
+    except sqlite3.Error as e:
+        mark_ready("history", e)
+
+
+threading.Thread(target=store_thread, daemon=True).start()
+atexit.register(store.flush)   # 正常退出时把内存里的样本写完
+
+# ================================================================
+# 用电统计：每个设备每小时 / 每天亮了多久、估算耗电量（/api/usage）
+# ================================================================
+# 只在 run_commands() 的状态切换时更新：开灯记下时间，关灯时把这段时长按小时 / 天
+# 切开累加到固定的桶里，查询时直接读桶，不扫描日志。报警 / 规则闪烁直接写引脚，
+# 不经过 run_commands()，所以不会被计入。
+# 每个小时片段同时写进时序存储（series = "usage:<设备>"），汇总表里的小时累加值
+# 就是开灯秒数，重启后从那里回填内存里的小时桶和天桶。
+# “一天”按本地时间的零点切分：用固定的 UTC 偏移（SMARTHOME_UTC_OFFSET，单位小时，
+# 默认取启动时的本地时区），夏令时切换后需要重启才会生效；
+# 非整点时区（例如 +5:30）重启回填时小时桶会有半小时的误差
+USAGE_HOURS = 7 * 24     # 内存里保留最近 7 天的小时桶
+USAGE_DAYS = 366         # 以及最近一年的天桶
+USAGE_RESOLUTIONS = {3600: USAGE_HOURS, 86400: USAGE_DAYS}
+USAGE_UTC_OFFSET = int(float(os.environ.get("SMARTHOME_UTC_OFFSET",
+                                            time.localtime().tm_gmtoff / 3600)) * 3600)
+
+
+def bucket_start(t, res, offset=0):
+    # 按本地时间（UTC + offset 秒）对齐的桶起点，仍然用 UTC 时间戳表示
+    return int((t + offset) // res * res - offset)
+
+
+def split_interval(t0, t1, res, offset=0):
+    # 把 [t0, t1) 按 res 对齐切开：[(bucket, 秒数), ...]
+    while t0 < t1:
+        bucket = bucket_start(t0, res, offset)
+        end = min(t1, bucket + res)
+        yield bucket, end - t0
+        t0 = end
+
+
+class UsageMeter:
+
+    def __init__(self, devices):
+        self.lock = threading.Lock()
+        self.watts = {name: d.watts for name, d in devices.items()}
+        self.on_since = {name: None for name in devices}   # 亮着的设备：从何时开始计时
+        # res -> 设备 -> {bucket: 秒数}；桶按时间顺序插入，最早的总在最前面
+        self.buckets = {res: {name: {} for name in devices} for res in USAGE_RESOLUTIONS}
+        self.turn_ons = {name: 0 for name in devices}
+
+    def load(self, store):
+        # 重启后从小时汇总表回填（每个设备一次索引查询）。汇总表的天桶按 UTC 切分，
+        # 不能直接用，天桶由小时桶按本地零点重新累加
+        now = time.time()
+        since = {res: bucket_start(now, res, USAGE_UTC_OFFSET) - (keep - 1) * res
+                 for res, keep in USAGE_RESOLUTIONS.items()}
+        for name in self.on_since:
+            for hour, total in store.bucket_sums("usage:" + name, 3600, min(since.values())):
+                for res in USAGE_RESOLUTIONS:
+                    bucket = bucket_start(hour, res, USAGE_UTC_OFFSET)
+                    if bucket >= since[res]:
+                        buckets = self.buckets[res][name]
+                        buckets[bucket] = buckets.get(bucket, 0.0) + total
+
+    def add(self, name, t0, t1):
+        for res, keep in USAGE_RESOLUTIONS.items():
+            buckets = self.buckets[res][name]
+            for bucket, seconds in split_interval(t0, t1, res, USAGE_UTC_OFFSET):
+                buckets[bucket] = buckets.get(bucket, 0.0) + seconds
+                if res == 3600:
+                    store.add("usage:" + name, bucket, seconds)
+            while len(buckets) > keep:
+                del buckets[next(iter(buckets))]
+
+    def switch(self, name, on, now=None):
+        # 每次状态切换 O(1)：开灯只记时间，关灯累加这一段
+        now = time.time() if now is None else now
+        with self.lock:
+            since = self.on_since[name]
+            if on and since is None:
+                self.on_since[name] = now
+                self.turn_ons[name] += 1
+            elif not on and since is not None:
+                self.on_since[name] = None
+                self.add(name, since, now)
+
+    def checkpoint(self):
+        # 定期把还亮着的灯到现在为止的时长记上，进程意外退出最多丢一个写库周期
+        now = time.time()
+        with self.lock:
+            for name, since in self.on_since.items():
+                if since is not None and now > since:
+                    self.add(name, since, now)
+                    self.on_since[name] = now
+
+    def report(self, res, count, names):
+        # 最近 count 个桶（最后一个是当前小时 / 当天，包含还亮着的这一段）
+        now = time.time()
+        first = bucket_start(now, res, USAGE_UTC_OFFSET) - (count - 1) * res
+        out = {}
+        with self.lock:
+            for name in names:
+                buckets = self.buckets[res][name]
+                seconds = [buckets.get(first + i * res, 0.0) for i in range(count)]
+                since = self.on_since[name]
+                if since is not None:
+                    for bucket, extra in split_interval(max(since, first), now, res, USAGE_UTC_OFFSET):
+                        seconds[(bucket - first) // res] += extra
+                watts = self.watts[name]
+                total = sum(seconds)
+                out[name] = {
+                    "on": since is not None,
+                    "watts": watts,
+                    "turn_ons": self.turn_ons[name],   # 本次启动以来开了几次
+                    "seconds": [round(v, 1) for v in seconds],
+                    "wh": [round(v * watts / 3600, 2) for v in seconds] if watts is not None else None,
+                    "total_seconds": round(total, 1),
+                    "total_wh": round(total * watts / 3600, 2) if watts is not None else None,
+                }
+        return first, out
+
+
+with BootStep("usage"):
+    usage = UsageMeter(registry.devices)
+    usage.load(store)
+
+atexit.register(usage.checkpoint)   # atexit 后注册先执行：先记时长，再写库
+
+# ================================================================
+# 事件日志（灯光状态变化 / 报警切换）+ 状态快照
+# ================================================================
+# 只追加不修改。事件先进内存队列，日志线程每 JOURNAL_COMMIT_INTERVAL 秒把一批
+# 写成一个事务（synchronous=FULL，每批只 fsync 一次，而不是每个事件一次）；
+# 每 JOURNAL_SNAPSHOT_EVERY 个状态事件在同一个事务里写一份完整状态快照，
+# 重启时读最新快照 + 重放之后的事件即可恢复，不需要从头扫描日志
+JOURNAL_COMMIT_INTERVAL = 1.0     # 组提交间隔（秒），断电最多丢这么长时间的事件
+JOURNAL_SNAPSHOT_EVERY = 256      # 每多少个状态事件做一次快照
+JOURNAL_SNAPSHOTS_KEEP = 2        # 只保留最近几份快照
+JOURNAL_RETENTION = 180 * 86400   # 日志保留 180 天（最新快照之后的事件永远保留）
+JOURNAL_QUERY_LIMIT = 1000
+
+
+class Journal:
+
+    def __init__(self, path):
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.states = {}          # 最新状态（包含还没提交的事件），做快照用
+        self.since_snapshot = 0
+        self.events = 0
+        self.commits = 0
+
+        # 和时序存储共用一个数据库文件，单独一个连接：这里的提交要 fsync
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS journal(
+                seq INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                kind TEXT NOT NULL,
+                name TEXT NOT NULL,
+                value INTEGER NOT NULL,
+                source TEXT,
+                detail TEXT
+            );
+            CREATE INDEX IF NOT EXISTS journal_name_ts ON journal(name, ts);
+            CREATE INDEX IF NOT EXISTS journal_ts ON journal(ts);
+            CREATE TABLE IF NOT EXISTS snapshots(
+                seq INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                states TEXT NOT NULL
+            );
+        """)
+        self.conn.commit()
+
+    def restore(self):
+        # 最新快照 + 之后的状态事件 -> {设备 / 模式: 开关}
+        with self.db_lock:
+            row = self.conn.execute(
+                "SELECT seq, states FROM snapshots ORDER BY seq DESC LIMIT 1").fetchone()
+            seq, states = (row[0], json.loads(row[1])) if row else (0, {})
+            tail = self.conn.execute(
+                "SELECT name, value FROM journal WHERE seq > ? AND kind = 'state' ORDER BY seq",
+                (seq,)).fetchall()
+        for name, value in tail:
+            states[name] = bool(value)
+        with self.pending_lock:
+            self.states = dict(states)
+            self.since_snapshot = len(tail)
+        return states, len(tail)
+
+    def record(self, kind, name, value, source=None, detail=None):
+        with self.pending_lock:
+            self.pending.append((time.time(), kind, name, int(value), source, detail))
+            if kind == "state":
+                self.states[name] = bool(value)
+                self.since_snapshot += 1
+
+    def flush(self):
+        with self.pending_lock:
+            batch, self.pending = self.pending, []
+            snapshot = None
+            if self.since_snapshot >= JOURNAL_SNAPSHOT_EVERY:
+                snapshot = dump_json(self.states)   # 和这一批事件一致
+                self.since_snapshot = 0
+        if not batch:
+            return
+
         try:
-            t = dht.temperature
-            if t is not None and t > ALARM_TEMP:
-                alarm_active = True
-                # LED 快速闪烁
-                for _ in range(5):
-                    GPIO.output(PIN_HALL, GPIO.HIGH)
-                    time.sleep(0.1)
-                    GPIO.output(PIN_HALL, GPIO.LOW)
-                    time.sleep(0.1)
+            with self.db_lock, self.conn:
+                self.conn.executemany(
+                    "INSERT INTO journal(ts, kind, name, value, source, detail) VALUES (?, ?, ?, ?, ?, ?)",
+                    batch)
+                if snapshot is not None:
+                    self.conn.execute(
+                        "INSERT INTO snapshots(seq, ts, states) VALUES ((SELECT MAX(seq) FROM journal), ?, ?)",
+                        (time.time(), snapshot))
+                    self.conn.execute(
+                        "DELETE FROM snapshots WHERE seq NOT IN "
+                        "(SELECT seq FROM snapshots ORDER BY seq DESC LIMIT ?)",
+                        (JOURNAL_SNAPSHOTS_KEEP,))
+            self.events += len(batch)
+            self.commits += 1
+        except sqlite3.Error as e:
+            print("[JOURNAL ERROR]", e, flush=True)
+
+    def maintain(self):
+        # 删除过期事件，但不删最新快照之后的（恢复时要重放）
+        try:
+            with self.db_lock, self.conn:
+                self.conn.execute("""
+                    DELETE FROM journal WHERE ts < ?
+                    AND seq <= COALESCE((SELECT MAX(seq) FROM snapshots), 0)
+                """, (time.time() - JOURNAL_RETENTION,))
+        except sqlite3.Error as e:
+            print("[JOURNAL ERROR]", e, flush=True)
+
+    def query(self, name=None, kind=None, t0=None, t1=None, before=None, limit=100):
+        # 新的在前；按名字查走 (name, ts) 索引，只按时间查走 ts 索引。
+        # 还没提交的事件（最多 JOURNAL_COMMIT_INTERVAL 秒）不在结果里
+        where, args = [], []
+        for clause, value in (("name = ?", name), ("kind = ?", kind), ("ts >= ?", t0),
+                              ("ts <= ?", t1), ("seq < ?", before)):
+            if value is not None:
+                where.append(clause)
+                args.append(value)
+        sql = "SELECT seq, ts, kind, name, value, source, detail FROM journal"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts DESC, seq DESC LIMIT ?"
+        with self.db_lock:
+            return self.conn.execute(sql, args + [limit]).fetchall()
+
+
+def journal_thread():
+    last_maintain = time.monotonic()
+    while True:
+        time.sleep(JOURNAL_COMMIT_INTERVAL)
+        journal.flush()
+        if time.monotonic() - last_maintain >= DB_MAINTAIN_INTERVAL:
+            last_maintain = time.monotonic()
+            journal.maintain()
+
+
+def restore_state():
+    # 恢复上次关机前的灯光和模式；配置里已经没有的名字直接忽略
+    global state_mask
+    states, replayed = journal.restore()
+    mask = 0
+    for name, on in states.items():
+        if not on:
+            continue
+        if name in registry.devices:
+            mask |= 1 << registry.devices[name].bit
+        elif name in registry.modes:
+            mask |= registry.modes[name]
+    with state_lock:
+        if mask & registry.device_mask:
+            registry.write(mask & registry.device_mask, mask)
+        state_mask = mask
+        device_states.update(registry.states(mask))
+        publish_state()
+        for name in registry.devices:
+            if device_states[name]:
+                usage.switch(name, True)
+    print("[JOURNAL] restored %d on, replayed %d events" % (bin(mask).count("1"), replayed), flush=True)
+
+
+with BootStep("journal"):
+    journal = Journal(DB_PATH)
+    restore_state()
+
+threading.Thread(target=journal_thread, name="journal", daemon=True).start()
+atexit.register(journal.flush)
+
+# ================================================================
+# 报警引擎：每个新样本触发一次判断（回差 + 去抖）
+# ================================================================
+ALARM_TEMP = 31.0     # 31°C 以上触发报警
+
+# above / below：触发阈值；clear：恢复阈值（回差，避免在阈值附近反复跳变）；
+# debounce：连续多少个样本满足条件才切换状态；blink：报警时是否闪灯（否则只弹窗）；
+# system：系统报警，不算进 /api/temp 的 alarm，在 /api/system 和 /cpu_temp 里单独报告
+ALARM_RULES = [
+    {"name": "high_temp", "field": "temp", "above": ALARM_TEMP, "clear": ALARM_TEMP - 0.5,
+     "debounce": 2, "label": "High Temperature", "unit": "°C", "blink": True},
+    {"name": "high_humidity", "field": "hum", "above": 85.0, "clear": 80.0,
+     "debounce": 3, "label": "High Humidity", "unit": "%", "blink": True},
+    {"name": "low_temp", "field": "temp", "below": 5.0, "clear": 6.0,
+     "debounce": 3, "label": "Low Temperature", "unit": "°C", "blink": True},
+    # 下面几条由系统监控（SystemSample）触发，不闪灯：
+    # 电源偏弱的树莓派可能长期欠压，不能因此让走廊灯一直闪
+    {"name": "cpu_hot", "field": "cpu", "above": 80.0, "clear": 75.0,
+     "debounce": 3, "label": "CPU Overheating", "unit": "°C", "system": True},
+    {"name": "throttled", "field": "throttling", "above": 0, "clear": 0,
+     "debounce": 2, "label": "CPU Throttled", "unit": "", "system": True},
+    {"name": "undervoltage", "field": "undervoltage", "above": 0, "clear": 0,
+     "debounce": 2, "label": "Power Supply Under-voltage", "unit": "", "system": True},
+]
+
+# 报警时走廊灯快速闪烁 5 次，每 2 秒一轮
+ALARM_BLINK = [(True, 0.1), (False, 0.1)] * 5
+ALARM_BLINK_REPEAT = 2.0
+
+alarm_active = False   # 任意一条室内温湿度规则处于报警状态（不含系统报警）
+
+
+class AlarmEngine:
+
+    def __init__(self, rules, pattern):
+        self.rules = rules
+        self.pattern = pattern
+        self.active = {r["name"]: False for r in rules}
+        self.counts = {r["name"]: 0 for r in rules}
+        self.activations = {r["name"]: 0 for r in rules}
+        self.messages = {}
+        self.system = {r["name"] for r in rules if r.get("system")}
+        self.system_version = 0   # 系统报警每次切换 +1，作为 /api/system、/cpu_temp 的缓存版本
+        self.lock = threading.Lock()   # 采样线程和系统监控都会调用 on_sample
+
+    def tripped(self, rule, value):
+        if "above" in rule:
+            return value > rule["above"] if not self.active[rule["name"]] else value > rule["clear"]
+        return value < rule["below"] if not self.active[rule["name"]] else value < rule["clear"]
+
+    def on_sample(self, sample):
+        with self.lock:
+            self.check(sample)
+
+    def check(self, sample):
+        global alarm_active
+        for rule in self.rules:
+            name = rule["name"]
+            value = getattr(sample, rule["field"], None)
+            if value is None:
+                continue   # 这个样本不含该字段（室内样本 / 系统样本）
+            # 当前状态与“应该的状态”不一致时计数，连续 debounce 次才切换
+            if self.tripped(rule, value) != self.active[name]:
+                self.counts[name] += 1
             else:
-                alarm_active = False
-        except Exception:
-            pass
-        time.sleep(2)
+                self.counts[name] = 0
+            if self.counts[name] < rule["debounce"]:
+                continue
+
+            self.counts[name] = 0
+            self.active[name] = not self.active[name]
+            if self.active[name]:
+                self.activations[name] += 1
+                self.messages[name] = "%s! Current: %s%s" % (rule["label"], value, rule["unit"])
+            else:
+                self.messages.pop(name, None)
+            if name in self.system:
+                self.system_version += 1
+            else:
+                alarm_active = any(on for n, on in self.active.items() if n not in self.system)
+            journal.record("alarm", name, self.active[name], "alarm", str(value))
+            if self.pattern is not None and rule.get("blink"):
+                if any(self.active[r["name"]] for r in self.rules if r.get("blink")):
+                    self.pattern.start()
+                else:
+                    self.pattern.stop()
+            hub.publish("alarm", self.payload(latest_sample, name, value))
+
+    def payload(self, sample, name=None, value=None):
+        return {
+            "active": alarm_active,
+            "temp": sample.temp if sample is not None else None,
+            "alarms": dict(self.active),
+            "messages": [m for n, m in self.messages.items() if n not in self.system],
+            "system": self.system_messages(),
+            "name": name,
+            "value": value,
+        }
+
+    def system_messages(self):
+        return [m for n, m in self.messages.items() if n in self.system]
+
+
+alarms = AlarmEngine(ALARM_RULES, LedPattern(registry.alarm_blink, ALARM_BLINK, ALARM_BLINK_REPEAT)
+                     if registry.alarm_blink else None)
+
+# ================================================================
+# 自动化规则引擎（rules.json）
+# ================================================================
+# 规则按传感器 / 设备建立索引：新样本或状态变化时只评估引用了它的规则；
+# 所有 “持续 N 秒” 和 “每天 HH:MM” 的定时都挂在同一个时间轮上
+#
+# 规则示例（完整例子见 rules.example.json）：
+#   {"name": "hot", "when": {"sensor": "temp", "op": ">", "value": 28, "for": 120}, "then": ["main_on"]}
+#   {"name": "bedtime", "when": {"at": "23:00"}, "then": {"scene": "sleep"}}
+#   {"name": "humid", "when": {"sensor": "hum", "trend": "rising", "window": 5, "delta": 3}, "then": {"blink": "hall"}}
+#   {"name": "follow", "when": {"device": "main", "is": false}, "then": ["hall_off"]}
+RULES_PATH = os.environ.get("SMARTHOME_RULES", os.path.join(BASE_DIR, "rules.json"))
+
+WHEEL_SLOTS = 512    # 时间轮槽数
+WHEEL_TICK = 1.0     # 每槽 1 秒
+
+RULE_OPS = {
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+}
+
+RULE_SENSOR_FIELDS = ("temp", "hum")   # Sample 里可以写进规则的字段
+RULE_TRENDS = ("rising", "falling")
+
+# 一次性的闪烁动作（闪 3 下后恢复原状态）
+RULE_BLINK = [(True, 0.2), (False, 0.2)] * 3
+
+
+class TimerWheel:
+    # 哈希时间轮：插入 / 取消都是 O(1)，每个 tick 只处理一个槽；
+    # 超过一圈的定时用 rounds 记录还要转几圈
+
+    def __init__(self, slots, tick):
+        self.slots = [[] for _ in range(slots)]
+        self.tick = tick
+        self.pos = 0
+        self.lock = threading.Lock()
+        self.next_tick = time.monotonic() + tick
+        scheduler.call_later(tick, self.advance)
+
+    def add(self, delay, fn):
+        n = len(self.slots)
+        with self.lock:
+            # 从下一次 tick 起算，保证不会比 delay 提前触发
+            first = self.next_tick - time.monotonic()
+            ticks = 1 + max(0, int(math.ceil((delay - first) / self.tick)))
+            entry = [(ticks - 1) // n, fn]   # [剩余圈数, 回调]
+            self.slots[(self.pos + ticks) % n].append(entry)
+        return entry
+
+    def cancel(self, entry):
+        entry[1] = None
+
+    def advance(self):
+        due = []
+        with self.lock:
+            self.pos = (self.pos + 1) % len(self.slots)
+            keep = []
+            for entry in self.slots[self.pos]:
+                if entry[1] is None:
+                    continue
+                if entry[0] == 0:
+                    due.append(entry[1])
+                else:
+                    entry[0] -= 1
+                    keep.append(entry)
+            self.slots[self.pos] = keep
+            # 按绝对时间排下一次，避免累计误差
+            self.next_tick += self.tick
+        scheduler.call_later(max(0.0, self.next_tick - time.monotonic()), self.advance)
+        for fn in due:
+            try:
+                fn()
+            except Exception as e:
+                print("[RULE ERROR]", e, flush=True)
+
+
+def seconds_until(hhmm):
+    hour, minute = (int(x) for x in hhmm.split(":"))
+    now = datetime.datetime.now()
+    at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if at <= now:
+        at += datetime.timedelta(days=1)
+    return (at - now).total_seconds()
+
+
+class RuleEngine:
+
+    def __init__(self, rules):
+        self.wheel = TimerWheel(WHEEL_SLOTS, WHEEL_TICK)
+        self.by_sensor = {}   # 传感器字段 -> [规则]
+        self.by_device = {}   # 设备名 -> [规则]
+        self.trends = {}      # 传感器字段 -> 最近的数值（用于 rising / falling）
+        self.state = {}       # 规则名 -> {"cond": 当前条件, "timer": 时间轮条目}
+        self.fires = {}       # 规则名 -> 执行次数
+        self.blinks = {}
+        for rule in rules:
+            try:
+                self.add(rule)
+            except (KeyError, ValueError, TypeError) as e:
+                name = rule.get("name") if isinstance(rule, dict) else rule
+                print("[RULE ERROR] skip %r: %s" % (name, e), flush=True)
+
+    def add(self, rule):
+        name = rule["name"]
+        if not isinstance(name, str):
+            raise TypeError("rule name must be a string")
+        if name in self.state:
+            raise ValueError("duplicate rule name " + name)   # 同名规则会共用一份 state
+        # 数值在加载时转换好存进规则的副本，评估时直接用；缺少或不是数字时这里就报错，规则被跳过
+        when = dict(rule["when"])
+        rule = dict(rule, when=when)
+        when["for"] = float(when.get("for", 0))
+        self.check_action(rule["then"])
+        if "sensor" in when:
+            if when["sensor"] not in RULE_SENSOR_FIELDS:
+                raise ValueError("unknown sensor field " + str(when["sensor"]))
+            if "trend" in when:
+                if when["trend"] not in RULE_TRENDS:
+                    raise ValueError("unknown trend " + str(when["trend"]))
+                when["delta"] = float(when.get("delta", 1.0))
+                when["window"] = window = int(when.get("window", 5))
+                if window < 1:
+                    raise ValueError("window must be at least 1")
+                old = self.trends.get(when["sensor"])
+                if old is None or old.maxlen < window + 1:
+                    self.trends[when["sensor"]] = deque(old or (), maxlen=window + 1)
+            elif when["op"] not in RULE_OPS:
+                raise ValueError("unknown op " + str(when["op"]))
+            else:
+                when["value"] = float(when["value"])
+            self.register(rule)
+            self.by_sensor.setdefault(when["sensor"], []).append(rule)
+        elif "device" in when:
+            if when["device"] not in device_states:
+                raise ValueError("unknown device " + str(when["device"]))
+            if not isinstance(when["is"], bool):
+                raise ValueError("'is' must be true or false")
+            self.register(rule)
+            self.by_device.setdefault(when["device"], []).append(rule)
+        elif "at" in when:
+            seconds_until(when["at"])   # 提前检查格式
+            self.register(rule)
+            self.arm_daily(rule)
+        else:
+            raise ValueError("rule needs sensor / device / at")
+
+    def register(self, rule):
+        # 检查全部通过之后才登记，被跳过的规则不会出现在 state / fires（/metrics）里
+        self.state[rule["name"]] = {"cond": False, "timer": None}
+        self.fires[rule["name"]] = 0
+
+    def check_action(self, then):
+        if isinstance(then, list):
+            unknown = [c for c in then if c not in COMMANDS]
+            if unknown:
+                raise ValueError("unknown command " + ", ".join(unknown))
+        elif "scene" in then:
+            SCENES[then["scene"]]
+        elif "blink" in then:
+            registry.devices[then["blink"]]
+        else:
+            raise ValueError("unknown action")
+
+    # ---------------- 触发入口 ----------------
+    def on_sample(self, sample):
+        for field, values in self.trends.items():
+            values.append(getattr(sample, field))
+        for field, rules in self.by_sensor.items():
+            value = getattr(sample, field)
+            for rule in rules:
+                self.guarded(rule, lambda: self.update(rule, self.sensor_cond(rule["when"], field, value)))
+
+    def on_state(self, changed, states):
+        for name in changed:
+            for rule in self.by_device.get(name, ()):
+                self.guarded(rule, lambda: self.update(rule, states[name] == rule["when"]["is"]))
+
+    def guarded(self, rule, fn):
+        # 一条规则出错只影响它自己，不能打断采样线程后面的历史 / 写库
+        try:
+            fn()
+        except Exception as e:
+            print("[RULE ERROR]", rule["name"], e, flush=True)
+
+    def sensor_cond(self, when, field, value):
+        if "trend" in when:
+            values = self.trends[field]
+            window = when["window"]
+            if len(values) <= window:
+                return False
+            change = values[-1] - values[-1 - window]
+            delta = when["delta"]
+            return change >= delta if when["trend"] == "rising" else change <= -delta
+        return RULE_OPS[when["op"]](value, when["value"])
+
+    # ---------------- 边沿触发 + 持续时间 ----------------
+    def update(self, rule, cond):
+        st = self.state[rule["name"]]
+        if cond == st["cond"]:
+            return
+        st["cond"] = cond
+        if st["timer"] is not None:
+            self.wheel.cancel(st["timer"])
+            st["timer"] = None
+        if not cond:
+            return
+        hold = rule["when"]["for"]
+        if hold <= 0:
+            self.fire(rule)
+        else:
+            # 条件持续 hold 秒仍然成立才执行；期间条件消失会取消定时
+            st["timer"] = self.wheel.add(hold, lambda: self.fire_if_held(rule))
+
+    def fire_if_held(self, rule):
+        st = self.state[rule["name"]]
+        st["timer"] = None
+        if st["cond"]:
+            self.fire(rule)
+
+    def arm_daily(self, rule):
+        def run():
+            self.fire(rule)
+            self.arm_daily(rule)
+        self.state[rule["name"]]["timer"] = self.wheel.add(seconds_until(rule["when"]["at"]), run)
+
+    def fire(self, rule):
+        # 放到调度器线程执行，避免在 state_lock / 采样线程里递归执行命令
+        scheduler.call_later(0, lambda: self.execute(rule))
+
+    def execute(self, rule):
+        then = rule["then"]
+        print("[RULE]", rule["name"], flush=True)
+        self.fires[rule["name"]] += 1
+        if isinstance(then, list):
+            run_commands(then, "rule:" + rule["name"])
+        elif "scene" in then:
+            run_commands(SCENES[then["scene"]], "rule:" + rule["name"])
+        else:
+            device = then["blink"]
+            if device not in self.blinks:
+                self.blinks[device] = LedPattern(device, RULE_BLINK, None)
+            self.blinks[device].start()
+
+
+def load_rules(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+rules = RuleEngine(load_rules(RULES_PATH))
+
+# ================================================================
+# CPU / 温度监控：固定节奏读取，接口只返回缓存的快照
+# ================================================================
+# 所有 thermal zone、CPU 频率、降频标志和负载的文件都只打开一次，之后用 pread 重读；
+# 每个周期整体替换 snapshot，接口开销和客户端数量无关
+MONITOR_INTERVAL = 2.0
+MONITOR_HISTORY = 150   # 保留最近 5 分钟
+
+# 交给报警引擎的系统样本：cpu = 第一个 thermal zone；
+# throttling = 当前是否降频；undervoltage = 当前是否欠压（两者分开报警）
+SystemSample = namedtuple("SystemSample", ["cpu", "throttling", "undervoltage", "ts", "mono", "seq"])
+UNDERVOLTAGE_NOW_MASK = 0x1   # 第 0 位：欠压
+THROTTLED_NOW_MASK = 0xE      # 第 1-3 位：频率封顶、正在降频、温度软限制
+
+
+class SystemMonitor:
+
+    def __init__(self):
+        self.source = None     # 第一次 tick 时才打开 sysfs 文件
+        self.snapshot = None   # 第一次读取之前为 None
+        self.seq = 0
+        self.history = deque(maxlen=MONITOR_HISTORY)   # (ts, cpu, 最高频率, load1)
+        self.next_run = time.monotonic()
+        scheduler.call_later(0, self.tick)
+
+    def tick(self):
+        self.next_run += MONITOR_INTERVAL
+        scheduler.call_later(max(0.0, self.next_run - time.monotonic()), self.tick)
+
+        if self.source is None:
+            self.source = hw.open_system()
+        with span("system"):
+            data = self.source.read()
+        zones = data["zones"]
+        cpu = zones[0]["temp"] if zones else None
+        throttled = data["throttled"]
+        ts = time.time()
+        self.seq += 1
+        data.update(cpu=cpu, ts=ts, seq=self.seq)
+        self.snapshot = data
+        self.history.append((ts, cpu, max(data["freq_mhz"], default=None),
+                             data["load"][0] if data["load"] else None))
+        mark_ready("monitor")
+        alarms.on_sample(SystemSample(
+            cpu,
+            None if throttled is None else int(bool(throttled & THROTTLED_NOW_MASK)),
+            None if throttled is None else int(bool(throttled & UNDERVOLTAGE_NOW_MASK)),
+            ts, time.monotonic(), self.seq))
+
+    def history_columns(self):
+        rows = list(self.history)
+        return {
+            "ts": [r[0] for r in rows],
+            "cpu": [r[1] for r in rows],
+            "freq_mhz": [r[2] for r in rows],
+            "load1": [r[3] for r in rows],
+        }
+
+
+monitor = SystemMonitor()
+
+# ================================================================
+# 温湿度后台采样线程（唯一读取传感器的地方）
+# ================================================================
+SAMPLE_STALE_AFTER = 10.0  # 超过 10 秒没有新样本就标记为 stale
+SENSOR_READ_GAP = 0.25     # 两次读取（不同传感器）之间至少空出 0.25 秒
+
+# 不可变的样本快照：采样线程每次整体替换 latest_sample，读取方不需要加锁
+# mono 是 time.monotonic() 时间，用来计算样本年龄（不受系统校时影响）
+Sample = namedtuple("Sample", ["temp", "hum", "ts", "mono", "seq", "sensor"])
+
+latest_sample = None   # 主传感器的最新样本，第一次成功读取之前为 None
+
+
+def read_cpu_temp():
+    snapshot = monitor.snapshot
+    return snapshot["cpu"] if snapshot is not None else None
+
+
+def on_new_sample(sensor, sample):
+    # 每个新样本都会调用这里：推送给网页，并按 HISTORY_INTERVAL 写入历史缓冲区和数据库
+    hub.publish("room", {"id": sensor.id, "temp": sample.temp, "hum": sample.hum, "ts": sample.ts})
+    if sensor.primary:
+        hub.publish("sample", {"temp": sample.temp, "hum": sample.hum, "ts": sample.ts})
+        alarms.on_sample(sample)
+        rules.on_sample(sample)
+    if sample.ts - sensor.last_history_ts >= HISTORY_INTERVAL:
+        sensor.last_history_ts = sample.ts
+        store.add(sensor.prefix + "temp", sample.ts, sample.temp)
+        store.add(sensor.prefix + "hum", sample.ts, sample.hum)
+        if sensor.primary:
+            history.append(sample.ts, sample.temp, sample.hum)
+            # 与 /api/history?since= 相同的列式结构，网页直接追加到图表窗口
+            hub.publish("history", {"ts": [sample.ts], "temp": [sample.temp], "hum": [sample.hum]})
+            cpu = read_cpu_temp()
+            if cpu is not None:
+                store.add("cpu", sample.ts, cpu)
+
+
+def read_sensor(sensor):
+    global latest_sample
+    metrics["dht_attempts"] += 1
+    if sensor.failed:
+        metrics["dht_retries"] += 1
+    if sensor.dev is None:
+        # 第一次读取时才打开驱动（树莓派上会导入 board / adafruit_dht）
+        try:
+            sensor.dev = worker.read(lambda: hw.open_sensor(sensor.kind, sensor.pin))
+        except Exception as e:
+            metrics["dht_errors"] += 1
+            mark_ready("sensors", e)
+            return
+        if all(s.dev is not None for s in sensors):
+            mark_ready("sensors")
+    sensor.failed = True
+    try:
+        with span("dht"):
+            t, h = worker.read(sensor.dev.read)
+        if t is not None and h is not None:
+            sensor.failed = False
+            sensor.seq += 1
+            sample = Sample(
+                round(float(t), 1), round(float(h), 1),
+                time.time(), time.monotonic(), sensor.seq, sensor.id
+            )
+            sensor.latest = sample
+            if sensor.primary:
+                latest_sample = sample
+            on_new_sample(sensor, sample)
+    except RuntimeError:
+        metrics["dht_failures"] += 1   # DHT22 偶尔校验失败属于正常现象，下个周期再读
+    except Exception as e:
+        metrics["dht_errors"] += 1
+        print("[DHT ERROR]", sensor.id, e, flush=True)
 
 
-# 启动报警线程
+def sampler_thread():
+    # 所有传感器在同一个线程里轮流读取，bit-bang 读取永远不会同时发生：
+    # 每个传感器按自己的周期排进堆里，初始相位均匀错开，两次读取之间至少间隔 SENSOR_READ_GAP
+    refill_history()
+    now = time.monotonic()
+    queue = [(now + i * s.interval / len(sensors), i, s) for i, s in enumerate(sensors)]
+    heapq.heapify(queue)
+    last_end = now - SENSOR_READ_GAP
+    while queue:
+        due, i, sensor = heapq.heappop(queue)
+        delay = max(due, last_end + SENSOR_READ_GAP) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        started = time.monotonic()
+        read_sensor(sensor)
+        last_end = time.monotonic()
+        # 下一次从本次开始时间算起，保证同一个传感器不会比最短间隔读得更快
+        heapq.heappush(queue, (max(due + sensor.interval, started + sensor.interval), i, sensor))
 
-threading.Thread(target=alarm_thread, daemon=True).start()
+
+def sample_age(sample):
+    return time.monotonic() - sample.mono
+
+
+threading.Thread(target=sampler_thread, daemon=True).start()
 
 # ================================================================
 # Flask 初始化
 # ================================================================
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)   # 静态文件由下面的预压缩缓存提供
+
+# ================================================================
+# JSON 响应缓存（ETag / 304）
+# ================================================================
+# 每个资源带一个版本号（状态计数器、样本编号等），版本不变时直接复用
+# 已经序列化好的 bytes；客户端带 If-None-Match 且版本一致时返回 304 空响应
+BOOT_ID = format(int(time.time()), "x")   # 重启后版本号从 0 开始，ETag 里加上启动标识
+
+json_cache = {}   # key -> (version, etag, body)
+
+
+def cached_json(key, version, build):
+    entry = json_cache.get(key)
+    if entry is None or entry[0] != version:
+        tag = f"{key}-{BOOT_ID}-" + "-".join(str(v) for v in version)
+        with span("json"):
+            entry = (version, tag, dump_json(build()).encode())
+        json_cache[key] = entry   # 整体替换，读取方不需要加锁
+    _, tag, body = entry
+
+    if request.if_none_match.contains(tag):
+        resp = Response(status=304)
+    else:
+        resp = Response(body, mimetype="application/json")
+    resp.set_etag(tag)
+    resp.headers["Cache-Control"] = "no-cache"   # 允许缓存，但每次都要带 ETag 验证
+    return resp
+
+# ================================================================
+# 静态资源：启动时一次性读入内存并预压缩
+# ================================================================
+# Chart.js 放在本地 static/ 目录，热点没有外网时页面也能完整打开；
+# 文件内容的 sha256 作为强 ETag，URL 里带上 ?v=<hash>，所以可以缓存一年
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+STATIC_TYPES = {
+    ".js": "text/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".svg": "image/svg+xml",
+    ".png": "image/png",
+}
+STATIC_MAX_AGE = "public, max-age=31536000, immutable"
+COMPRESS_MIN_SIZE = 1024   # 太小的文件压缩不划算
+
+# bodies: {"br" / "gzip" / "identity": bytes}
+Asset = namedtuple("Asset", ["etag", "content_type", "bodies"])
+
+
+def make_asset(body, content_type, compress=True):
+    asset = Asset(hashlib.sha256(body).hexdigest()[:20], content_type, {"identity": body})
+    if compress:
+        compress_asset(asset)
+    return asset
+
+
+def compress_asset(asset):
+    # 压缩好的版本直接加进 bodies；加进去之前 send_asset 只会发未压缩的
+    body = asset.bodies["identity"]
+    if len(body) < COMPRESS_MIN_SIZE or asset.content_type.startswith("image/png"):
+        return
+    asset.bodies["gzip"] = gzip.compress(body, 9, mtime=0)
+    if brotli is not None:
+        asset.bodies["br"] = brotli.compress(body, quality=11)
+
+
+def send_asset(asset, cache_control):
+    encoding = "identity"
+    for e in ("br", "gzip"):
+        if e in asset.bodies and request.accept_encodings[e]:
+            encoding = e
+            break
+    # 不同压缩格式是不同的表示，强 ETag 也要区分
+    tag = asset.etag if encoding == "identity" else f"{asset.etag}-{encoding}"
+
+    if request.if_none_match.contains(tag):
+        resp = Response(status=304)
+    else:
+        resp = Response(asset.bodies[encoding], content_type=asset.content_type)
+        if encoding != "identity":
+            resp.headers["Content-Encoding"] = encoding
+    resp.set_etag(tag)
+    resp.headers["Cache-Control"] = cache_control
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+
+def load_static_assets():
+    assets = {}
+    if not os.path.isdir(STATIC_DIR):
+        return assets
+    for name in sorted(os.listdir(STATIC_DIR)):
+        content_type = STATIC_TYPES.get(os.path.splitext(name)[1])
+        if content_type is None:
+            continue
+        with open(os.path.join(STATIC_DIR, name), "rb") as f:
+            # 200 KB 的 Chart.js 用最高级别压缩很慢，放到启动后的后台线程里做（warm_up）
+            assets[name] = make_asset(f.read(), content_type, compress=False)
+    return assets
+
+
+with BootStep("static_assets"):
+    static_assets = load_static_assets()
+
+
+def asset_url(name):
+    return f"/static/{name}?v={static_assets[name].etag}"
+
+
+@app.route("/static/<name>")
+def static_file(name):
+    asset = static_assets.get(name)
+    if asset is None:
+        return ("Not Found", 404)
+    return send_asset(asset, STATIC_MAX_AGE)
 
 # ================================================================
 # 生成二维码（扫码进入控制页面）
 # ================================================================
+# 不设置 SMARTHOME_PUBLIC_URL 时，按浏览器访问用的地址（scheme + Host）生成
+PUBLIC_URL = os.environ.get("SMARTHOME_PUBLIC_URL")
+QR_CACHE_SIZE = 16                     # 最多缓存 16 张编码好的图片
+QR_MIN_SIZE, QR_MAX_SIZE = 64, 1024    # size 参数：期望的图片宽度（像素）
+QR_MAX_AGE = "public, max-age=86400"
+
+qr_cache = OrderedDict()   # (url, size, fmt) -> Asset，按最近使用排序
+qr_cache_lock = threading.Lock()
+
+
+def render_qr(url, size, fmt):
+    with span("qr"):
+        return encode_qr(url, size, fmt)
+
+
+def encode_qr(url, size, fmt):
+    import qrcode.image.svg   # 第一次用到时才导入（通常已被 warm_up 提前导入）
+    qr = qrcode.QRCode(border=4)
+    qr.add_data(url)
+    qr.make(fit=True)
+    if size:
+        qr.box_size = max(1, size // (qr.modules_count + 2 * qr.border))
+
+    buffer = io.BytesIO()
+    if fmt == "svg":
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+        return make_asset(buffer.getvalue(), "image/svg+xml")
+    qr.make_image().save(buffer)
+    return make_asset(buffer.getvalue(), "image/png")
+
+
+def cached_qr(url, size, fmt):
+    key = (url, size, fmt)
+    with qr_cache_lock:
+        asset = qr_cache.get(key)
+        if asset is not None:
+            qr_cache.move_to_end(key)
+            return asset
+
+    asset = render_qr(url, size, fmt)   # 编码比较慢，不在锁里做
+    with qr_cache_lock:
+        qr_cache[key] = asset
+        while len(qr_cache) > QR_CACHE_SIZE:
+            qr_cache.popitem(last=False)
+    return asset
+
+
 @app.route("/qrcode")
 def qrcode_page():
-    url = f"https://192.168.137.28:5000/"
-    img = qrcode.make(url)
-    buffer = io.BytesIO()
-    img.save(buffer, "PNG")
-    buffer.seek(0)
-    return send_file(buffer, mimetype="image/png")
+    url = PUBLIC_URL or f"{request.scheme}://{request.host}/"
+    fmt = "svg" if request.args.get("format") == "svg" else "png"
+    try:
+        size = int(request.args.get("size", 0))
+    except ValueError:
+        return ("size must be an integer", 400)
+    if size:
+        size = max(QR_MIN_SIZE, min(size, QR_MAX_SIZE))
+    return send_asset(cached_qr(url, size, fmt), QR_MAX_AGE)
 
 
 PAGE_HTML = """
@@ -99,7 +2342,7 @@ PAGE_HTML = """
 <head>
 <meta charset="UTF-8">
 <title>Smart Home Control System</title>
-<script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
+<script src="{{ chart_js }}"></script>
 
 <style>
 body { background:#0d1117; color:#e6edf3; font-family:Arial; text-align:center; }
@@ -155,8 +2398,8 @@ button {
 </head>
 <body>
 
-<div id="alarm_popup>
-    <h2> TEMPERATURE ALERT <h2>
+<div id="alarm_popup">
+    <h2> TEMPERATURE ALERT </h2>
     <p id="alarm_popup_text"  style="font-size:20px;"></p>
 </div>
 
@@ -164,6 +2407,7 @@ button {
     <h2>System Status</h2>
     <p>Time: <span id="now_time">--:--:--</span></p>
     <p>CPU Temp: <span id="cpu_temp">-- °C</span></p>
+    <p id="system_alarm" style="color:red;"></p>
 </div>
 
 <h1>Smart Home Control System</h1>
@@ -222,37 +2466,26 @@ button {
 -->
 <div class="card">
     <h2>Scan to Access Control Page</h2>
-    <img class="qr" src="/qrcode" width="180">
+    <img class="qr" src="/qrcode?size=360" width="180">
 </div>
 
 <script>
+function showSample(d){
+    document.getElementById('temp').innerText = d.temp;
+    document.getElementById('hum').innerText = d.hum;
+}
+
 function refreshTemp(){
     fetch('/api/temp')
         .then(r => r.json())
         .then(d => {
-            document.getElementById('temp').innerText = d.temp;
-            document.getElementById('hum').innerText = d.hum;
-
+            showSample(d);
 // ---- 新增：更新网页报警状态 ----
             updateAlarmUI(d.alarm, d.temp);
-            if(d.temp !== "--" && d.hum !== "--"){
-                addPoint(d.temp, d.hum);
-            }
         })
-        .catch(e =>console.log("TEMP ERROR:", err));
+        .catch(e =>console.log("TEMP ERROR:", e));
 }
 
-setInterval(refreshTemp, 5000);
-refreshTemp();
-
-// -------------------------------------------------------
-// 灯光控制（发送 REST API）
-// -------------------------------------------------------
-function action(cmd){
-    fetch('/action/' + cmd);
-}
-
-
 // -------------------------------------------------------
 // 温湿度历史曲线
 // -------------------------------------------------------
@@ -270,15 +2503,61 @@ const chart = new Chart(ctx,{
     }
 });
 
-// 添加历史数据点
-function addPoint(t,h){
-    let time = new Date().toLocaleTimeString();
-    chart.data.labels.push(time);
-    chart.data.datasets[0].data.push(t);
-    chart.data.datasets[1].data.push(h);
-    chart.update();
+// 图表只保留最近 CHART_WINDOW 个点（10 秒一个，约 2 小时），超出的从左边丢掉；
+// 新数据先放进窗口，每帧最多重绘一次。窗口和游标存在 sessionStorage 里，
+// 刷新页面或重新连接时只用 /api/history?since=游标 取缺少的那一段
+const CHART_WINDOW = 720;
+const HISTORY_KEY = 'smarthome.history';
+let hist = {ts: [], temp: [], hum: []};
+let historyCursor = Date.now() / 1000 - CHART_WINDOW * 10;
+let chartPending = false;
+
+try {
+    let saved = JSON.parse(sessionStorage.getItem(HISTORY_KEY));
+    if(saved && saved.ts && saved.ts.length){
+        hist = saved;
+        historyCursor = saved.ts[saved.ts.length - 1];
+    }
+} catch(e) {}
+
+function appendHistory(d){
+    for(let i = 0; i < d.ts.length; i++){
+        if(d.ts[i] <= historyCursor) continue;   // SSE 补发和增量请求可能重叠
+        hist.ts.push(d.ts[i]);
+        hist.temp.push(d.temp[i]);
+        hist.hum.push(d.hum[i]);
+        historyCursor = d.ts[i];
+    }
+    let extra = hist.ts.length - CHART_WINDOW;
+    if(extra > 0){
+        hist.ts.splice(0, extra);
+        hist.temp.splice(0, extra);
+        hist.hum.splice(0, extra);
+    }
+    scheduleChart();
+}
+
+function scheduleChart(){
+    if(chartPending) return;
+    chartPending = true;
+    requestAnimationFrame(() => {
+        chartPending = false;
+        chart.data.labels = hist.ts.map(t => new Date(t * 1000).toLocaleTimeString());
+        chart.data.datasets[0].data = hist.temp;
+        chart.data.datasets[1].data = hist.hum;
+        chart.update('none');
+        try { sessionStorage.setItem(HISTORY_KEY, JSON.stringify(hist)); } catch(e) {}
+    });
 }
 
+function syncHistory(){
+    fetch('/api/history?since=' + historyCursor + '&limit=' + CHART_WINDOW)
+        .then(r => r.json())
+        .then(appendHistory)
+        .catch(e => console.log("HISTORY ERROR:", e));
+}
+scheduleChart();
+
 // -------------------------------------------------------
 // 语音控制（增强版英文）
 // -------------------------------------------------------
@@ -315,43 +2594,15 @@ function startVoice(){
         let text = e.results[e.results.length-1][0].transcript;
         document.getElementById('voice-status').innerText='Heard: '+text;
 
-        text = text.toLowerCase(); // 英文统一小写匹配
-
-        // ===========================
-        // 英文语音控制灯光
-        // ===========================
-        if(text.includes('turn on main light')){ action('main_on'); speak('Main light is now on'); }
-        if(text.includes('turn off main light')){ action('main_off'); speak('Main light is now off'); }
-
-        if(text.includes('turn on bedroom light')){ action('bedroom_on'); speak('Bedroom light on'); }
-        if(text.includes('turn off bedroom light')){ action('bedroom_off'); speak('Bedroom light off'); }
-
-        if(text.includes('turn on hallway light')){ action('hall_on'); speak('Hallway light on'); }
-        if(text.includes('turn off hallway light')){ action('hall_off'); speak('Hallway light off'); }
-
-        if(text.includes('turn on all lights')){ action('all_on'); speak('All lights are now on'); }
-        if(text.includes('turn off all lights')){ action('all_off'); speak('All lights are now off'); }
-
-        if(text.includes('night mode')){ action('night_mode'); speak('Night mode activated'); }
-
-
-
-        // ===========================
-        // 英文快捷口令（更自然）
-        // ===========================
-        if(text.includes('i am home')){ action('all_on'); speak('Welcome home, lights are on'); }
-        if(text.includes('i am leaving')){ action('all_off'); speak('Goodbye, lights turned off'); }
-        if(text.includes('i am going to sleep')){ action('night_mode'); speak('Good night, night mode on'); }
-
-
-        // ===========================
-        // 温湿度查询（语音播报）
-        // ===========================
-        if(text.includes('temperature') || text.includes('humidity')){
-            fetch('/api/temp').then(r=>r.json()).then(d=>{
-                speak(`Current temperature is ${d.temp} degrees, and humidity is ${d.hum} percent.`);
-            });
-        }
+        // 由服务端匹配口令（/api/intent），一句话只执行一个意图，回复文本和新状态一起返回
+        fetch('/api/intent', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({text: text})
+        }).then(r => r.json()).then(d => {
+            if(d.state) applyState(d.state);
+            speak(d.reply);
+        }).catch(e => console.log("INTENT ERROR:", e));
     };
 
     recog.onerror = function(){
@@ -374,40 +2625,116 @@ function update(id, state){
     b.className = state ? "on" : "off";
 }
 
-function refreshLights(){
-    fetch('/state').then(r=>r.json()).then(s=>{
+let stateVersion = 0;   // 同一连接里乱序到达的旧状态直接丢弃
 
-        update('main', s.main);
-        update('bedroom', s.bedroom);
-        update('hall', s.hall);
+function applyState(s){
+    if(s.version !== undefined){
+        if(s.version < stateVersion) return;
+        stateVersion = s.version;
+    }
+    update('main', s.main);
+    update('bedroom', s.bedroom);
+    update('hall', s.hall);
 
-        let all_on = s.main && s.bedroom && s.hall;
-        update('all', all_on);
+    let all_on = s.main && s.bedroom && s.hall;
+    update('all', all_on);
 
-        update('night', s.night);
-    });
+    update('night', s.night);
 }
-setInterval(refreshLights, 500);
-refreshLights();
 
-function toggle(id){
-    fetch('/state').then(r=>r.json()).then(s=>{
+function refreshLights(){
+    fetch('/state').then(r=>r.json()).then(applyState);
+}
 
-        if(id === 'all'){
-            let all_on = s.main && s.bedroom && s.hall;
-            fetch('/action/' + (all_on ? 'all_off' : 'all_on'));
-            return;
-        }
+// -------------------------------------------------------
+// 服务器推送（SSE）：状态、温湿度和报警都由 /events 推送
+// 只有浏览器不支持 EventSource 或者连接断开时才回退到轮询
+// -------------------------------------------------------
+let pollTimers = [];
+
+function startPolling(){
+    if(pollTimers.length) return;
+    pollTimers.push(setInterval(refreshLights, 500));
+    pollTimers.push(setInterval(refreshTemp, 5000));
+    pollTimers.push(setInterval(syncHistory, 10000));
+    refreshLights();
+    refreshTemp();
+    syncHistory();
+}
 
-        if(id === 'night'){
-            fetch('/action/' + (s.night ? 'night_off' : 'night_on'));
-            return;
-        }
+function stopPolling(){
+    pollTimers.forEach(clearInterval);
+    pollTimers = [];
+}
 
-        fetch('/action/' + (s[id] ? id + '_off' : id + '_on'));
+function connectEvents(){
+    if(!window.EventSource){
+        startPolling();
+        return;
+    }
+    let es = new EventSource('/events');
+    es.onopen = () => { stateVersion = 0; stopPolling(); syncHistory(); };   // 每次（重新）连接都补一次增量
+    es.onerror = startPolling;   // EventSource 会自动重连（带 Last-Event-ID）
+    es.addEventListener('state', e => applyState(JSON.parse(e.data)));
+    es.addEventListener('sample', e => showSample(JSON.parse(e.data)));
+    es.addEventListener('history', e => appendHistory(JSON.parse(e.data)));
+    es.addEventListener('alarm', e => {
+        let d = JSON.parse(e.data);
+        updateAlarmUI(d.active, d.temp, d.messages);
+        showSystemAlarms(d.system);
+    });
+}
+connectEvents();
+
+// 切换由服务端根据当前真实状态决定，只需要一次请求
+function runActions(body){
+    return fetch('/api/actions', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify(body)
+    }).then(r => r.json()).then(d => {
+        if(d.state) applyState(d.state);
+        return d;
     });
 }
 
+// -------------------------------------------------------
+// WebSocket 控制通道：按钮命令走已经打开的连接，断线时按指数退避重连，
+// 连接不可用时回退到 POST /api/actions
+// -------------------------------------------------------
+let ws = null;
+let wsBackoff = 500;
+let wsSeq = 0;
+
+function connectSocket(){
+    if(!window.WebSocket) return;
+    ws = new WebSocket((location.protocol === 'https:' ? 'wss://' : 'ws://') + location.host + '/ws');
+    ws.onopen = () => { wsBackoff = 500; stateVersion = 0; };
+    ws.onmessage = e => {
+        let d = JSON.parse(e.data);
+        if(d.state) applyState(d.state);
+        if(d.type === 'ack' && !d.ok) console.log("WS ERROR:", d.id, d.error);
+    };
+    ws.onclose = () => {
+        ws = null;
+        setTimeout(connectSocket, wsBackoff * (1 + Math.random() / 2));
+        wsBackoff = Math.min(wsBackoff * 2, 15000);
+    };
+}
+
+function sendCommands(cmds){
+    if(ws && ws.readyState === WebSocket.OPEN){
+        ws.send(JSON.stringify({id: 'c' + (++wsSeq), commands: cmds}));
+        return;
+    }
+    runActions({commands: cmds});
+}
+
+function toggle(id){
+    sendCommands(['toggle_' + id]);
+}
+connectSocket();
+
 function updateTime(){
     let now = new Date();
     document.getElementById("now_time").innerText =
@@ -421,21 +2748,29 @@ function updateCpuTemp(){
         .then(r=>r.json())
         .then(d=>{
             document.getElementById("cpu_temp").innerText = d.temp + " °C";
+            showSystemAlarms(d.alarms);
             checkAlert(d.temp);
         });
 }
 setInterval(updateCpuTemp, 3000);
 updateCpuTemp();
 
-function updateAlarmUI(alarm, temp){
+// 系统报警（CPU 过热 / 降频 / 欠压）显示在 System Status 卡片里，不弹温度报警窗
+function showSystemAlarms(messages){
+    document.getElementById("system_alarm").innerText = (messages || []).join("\\n");
+}
+
+function updateAlarmUI(alarm, temp, messages){
     let popup = document.getElementById("alarm_popup");
     let text = document.getElementById("alarm_popup_text");
 
     if(alarm){
-        card.style.display = "block";
-        text.innerText = "High Temperature! Current: " + temp + "°C";
+        popup.style.display = "block";
+        text.innerText = (messages && messages.length)
+            ? messages.join("\\n")
+            : "High Temperature! Current: " + temp + "°C";
     } else {
-        card.style.display = "none";
+        popup.style.display = "none";
     }
 }
 
@@ -452,235 +2787,1204 @@ function updateAlarmUI(alarm, temp){
 # ================================================================
 @app.route("/api/temp")
 def api_temp():
-    import time
-    try:
-        for _ in range(5):   # 尝试 5 次获取稳定值
-            try:
-                temperature = dht.temperature
-                humidity = dht.humidity
-                if (temperature is not None) and (humidity is not None):
-                    return jsonify({
-                        "temp": round(float(temperature), 1),
-                        "hum": round(float(humidity), 1),
-                        "fallback": False,
-                        "alarm:alarm_active,
-                        "ts": int(time.time())
-                    })
-            except RuntimeError:
-                time.sleep(1)
-
-        # 多次失败返回 fallback 值
-        raise RuntimeError("DHT22 read failed after retries")
-
-    except Exception as e:
-        print("[DHT ERROR]", e, flush=True)
-        return jsonify({
+    # 直接返回内存中的最新样本，不在请求线程里读传感器
+    sample = latest_sample
+    alarm = alarm_active
+    if sample is None:
+        # 还没有任何成功读数时返回 fallback 值
+        metrics["temp_fallback"] += 1
+        return cached_json("temp", (0, alarm), lambda: {
             "temp": 25.0,
             "hum": 50.0,
             "fallback": True,
-            "ts": int(time.time())
+            "alarm": alarm,
+            "ts": int(time.time()),
+            "age": None,
+            "stale": True
         })
 
-# ========== 温湿度 API ==========
-import Adafruit_DHT
+    # 版本 = 样本编号 + 是否过期 + 报警状态；age 是序列化时刻的样本年龄
+    stale = sample_age(sample) > SAMPLE_STALE_AFTER
+    return cached_json("temp", (sample.seq, int(stale), int(alarm)), lambda: {
+        "temp": sample.temp,
+        "hum": sample.hum,
+        "fallback": False,
+        "alarm": alarm,
+        "ts": int(sample.ts),
+        "age": round(sample_age(sample), 1),
+        "stale": stale
+    })
 
-DHT_SENSOR = Adafruit_DHT.DHT22
-DHT_PIN = 4  # 如果你的 DHT22 DATA 接 GPIO4，请保持这个。不确定可以告诉我。
+# ================================================================
+# 后端 API：历史温湿度（服务端降采样）
+# ================================================================
+HISTORY_MAX_POINTS = 2000
 
-@app.route("/api/temp")
-def temperature():
-    humidity, temperature = Adafruit_DHT.read_retry(DHT_SENSOR, DHT_PIN)
 
-    if humidity is None or temperature is None:
-        return jsonify({"temperature": None, "humidity": None})
+def room_payload(sensor):
+    sample = sensor.latest
+    out = {"id": sensor.id, "room": sensor.room, "kind": sensor.kind,
+           "temp": None, "hum": None, "ts": None, "age": None, "stale": True}
+    if sample is not None:
+        age = sample_age(sample)
+        out.update(temp=sample.temp, hum=sample.hum, ts=int(sample.ts),
+                   age=round(age, 1), stale=age > SAMPLE_STALE_AFTER)
+    return out
 
-    return jsonify({
-        "temperature": round(temperature, 1),
-        "humidity": round(humidity, 1)
+
+def room_version(sensor):
+    sample = sensor.latest
+    if sample is None:
+        return (0, 1)
+    return (sample.seq, int(sample_age(sample) > SAMPLE_STALE_AFTER))
+
+
+@app.route("/api/rooms")
+def api_rooms():
+    # 所有房间一次返回；版本 = 每个传感器的 (样本编号, 是否过期)
+    version = tuple(v for s in sensors for v in room_version(s))
+    return cached_json("rooms", version, lambda: {
+        "rooms": [room_payload(s) for s in sensors]
     })
 
+
+@app.route("/api/rooms/<sensor_id>")
+def api_room(sensor_id):
+    sensor = sensors_by_id.get(sensor_id)
+    if sensor is None:
+        return jsonify({"error": "unknown sensor: %s" % sensor_id}), 404
+    return cached_json("room-" + sensor.id, room_version(sensor), lambda: room_payload(sensor))
+
+
+def finite_float(value):
+    # float() 也接受 "nan" / "inf"，序列化出来不是合法 JSON，当作非法参数
+    x = float(value)
+    if not math.isfinite(x):
+        raise ValueError(value)
+    return x
+
+
+def history_delta(since, limit):
+    # 增量同步：只返回比客户端游标新的原始样本（并行数组），cursor 是下次请求要带的值
+    ts, temp, hum, truncated = history.since(since, limit)
+    return {
+        "ts": list(ts),
+        "temp": list(temp),
+        "hum": list(hum),
+        "cursor": ts[-1] if ts else since,
+        "truncated": truncated,
+    }
+
+
+@app.route("/api/history")
+def api_history():
+    now = time.time()
+    if "since" in request.args:
+        try:
+            since = finite_float(request.args["since"])
+            limit = int(request.args.get("limit", HISTORY_MAX_POINTS))
+        except ValueError:
+            return jsonify({"error": "since / limit must be numbers"}), 400
+        return jsonify(history_delta(since, max(1, min(limit, HISTORY_MAX_POINTS))))
+
+    try:
+        t1 = finite_float(request.args.get("to", now))
+        t0 = finite_float(request.args.get("from", t1 - 24 * 3600))
+        points = int(request.args.get("points", 300))
+    except ValueError:
+        return jsonify({"error": "from / to / points must be numbers"}), 400
+    if t0 > t1:
+        return jsonify({"error": "from must not be later than to"}), 400
+    points = max(1, min(points, HISTORY_MAX_POINTS))
+
+    sensor = sensors_by_id.get(request.args.get("sensor", sensors[0].id if sensors else None))
+    if sensor is None:
+        return jsonify({"error": "unknown sensor"}), 404
+
+    oldest = history.oldest()
+    if not sensor.primary:
+        # 内存环形缓冲区只保存主传感器，其他房间直接查数据库汇总表
+        data = store.history(t0, t1, points, sensor.prefix)
+    elif oldest is None or t1 < oldest:
+        # 整段都早于内存缓冲区：走数据库汇总表，不扫原始数据
+        data = store.history(t0, t1, points)
+    elif t0 >= oldest:
+        ts, temp, hum = history.range(t0, t1)
+        data = downsample(ts, temp, hum, t0, t1, points)
+    else:
+        # 跨越两边：oldest 之前查汇总表，之后用环形缓冲区（包含还没写库的最新样本），
+        # 点数按时间长度分配
+        db_points = max(1, min(points - 1, round(points * (oldest - t0) / (t1 - t0))))
+        data = store.history(t0, oldest, db_points)
+        keep = bisect.bisect_left(data["ts"], oldest)
+        ts, temp, hum = history.range(oldest, t1)
+        recent = downsample(ts, temp, hum, oldest, t1, max(1, points - db_points))
+        for key, column in data.items():
+            data[key] = column[:keep] + recent[key]
+    data.update({"from": t0, "to": t1, "points": len(data["ts"])})
+    return jsonify(data)
+
 # ================================================================
 # 后端：灯光与模式控制 API
 # ================================================================
 @app.route("/api/states")
 def api_states():
-    return jsonify({
-        "main": device_states.get("main", False),
-        "bedroom": device_states.get("bedroom", False),
-        "hall": device_states.get("hall", False),
-        "all": (
-            device_states.get("main", False)
-            or device_states.get("bedroom", False)
-            or device_states.get("hall", False)
-        ),
-        "night": device_states.get("night", False)
-    })
+    def build():
+        out = {name: device_states[name] for name in registry.devices}
+        out.update({name: device_states[name] for name in registry.modes})
+        # 这里的分组表示“至少有一个亮着”
+        out.update({name: bool(state_mask & mask) for name, mask in registry.groups.items()})
+        return out
+
+    return cached_json("states", (state_version,), build)
 
 @app.route('/toggle/<which>')
 def toggle(which):
-    # 主灯控制（自动 ON/OFF）
-    if which == "main":
-        device_states["main"] = not device_states["main"]
-        GPIO.output(PIN_MAIN, GPIO.HIGH if device_states["main"] else GPIO.LOW)
-
-    # 卧室灯
-    elif which == "bedroom":
-        device_states["bedroom"] = not device_states["bedroom"]
-        GPIO.output(PIN_BEDROOM, GPIO.HIGH if device_states["bedroom"] else GPIO.LOW)
-
-    # 走廊灯
-    elif which == "hall":
-        device_states["hall"] = not device_states["hall"]
-        GPIO.output(PIN_HALL, GPIO.HIGH if device_states["hall"] else GPIO.LOW)
-
-    # 全屋灯（重点！！你的之前代码缺少这个）
-    elif which == "all":
-        # 判断是否需要全开还是全关
-        new_state = not (device_states["main"] or device_states["bedroom"] or device_states["hall"])
-
-        # 更新所有灯光状态
-        device_states["main"] = new_state
-        device_states["bedroom"] = new_state
-        device_states["hall"] = new_state
-
-        # 实际 GPIO 输出
-        GPIO.output(PIN_MAIN, GPIO.HIGH if new_state else GPIO.LOW)
-        GPIO.output(PIN_BEDROOM, GPIO.HIGH if new_state else GPIO.LOW)
-        GPIO.output(PIN_HALL, GPIO.HIGH if new_state else GPIO.LOW)
-
-    # 夜间模式（只开走廊灯）
-    elif which == "night":
-        device_states["main"] = False
-        device_states["bedroom"] = False
-        device_states["hall"] = True
-
-        GPIO.output(PIN_MAIN, GPIO.LOW)
-        GPIO.output(PIN_BEDROOM, GPIO.LOW)
-        GPIO.output(PIN_HALL, GPIO.HIGH)
-
+    # main / bedroom / hall / all / night
+    try:
+        run_commands(["toggle_" + which], "http")
+    except ValueError:
+        return ("Unknown device", 404)
     return ("OK", 200)
 
 @app.route('/action/all')
 def action_all():
-    global main_light, bedroom_light, hall_light
-
     # 切换成相反状态
-    new_state = not main_light
+    return jsonify(run_commands(["toggle_all"], "http"))
 
-    main_light = new_state
-    bedroom_light = new_state
-    hall_light = new_state
+# 后端：灯光与模式控制 API
+# ================================================================
+@app.route('/action/<cmd>')
+def action(cmd):
+    # main_on / main_off / bedroom_on / ... / all_on / all_off / night_on / night_off
+    try:
+        run_commands([cmd], "http")
+    except ValueError:
+        return ("Unknown command", 404)
+    return ("OK", 200)
+
+
+# ================================================================
+# 后端：批量命令 / 场景 API（一次请求、一次加锁、一次 GPIO 写入）
+# ================================================================
+ACTIONS_USAGE = "expected {\"commands\": [...]} or {\"scene\": ...}"
+
+
+@app.route("/api/actions", methods=["POST"])
+def api_actions():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("scene", ""), str):
+        return jsonify({"error": ACTIONS_USAGE}), 400
+    if "scene" in body:
+        cmds = SCENES.get(body["scene"])
+        if cmds is None:
+            return jsonify({"error": "unknown scene: %s" % body["scene"]}), 404
+    else:
+        cmds = body.get("commands")
+        if not isinstance(cmds, list) or not all(isinstance(c, str) for c in cmds):
+            return jsonify({"error": ACTIONS_USAGE}), 400
+
+    try:
+        state = run_commands(cmds, "http")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"state": state, "version": state["version"]})
+
+
+# ================================================================
+# 后端：事件日志查询（谁在什么时候开关了什么、报警何时触发 / 解除）
+# ================================================================
+#   /api/journal?device=main&from=<ts>&to=<ts>&kind=state&limit=100
+# 结果新的在前；翻页时把上一页最后一条的 seq 作为 before 传回来
+@app.route("/api/journal")
+def api_journal():
+    try:
+        t0 = finite_float(request.args["from"]) if "from" in request.args else None
+        t1 = finite_float(request.args["to"]) if "to" in request.args else None
+        before = int(request.args["before"]) if "before" in request.args else None
+        limit = int(request.args.get("limit", 100))
+    except ValueError:
+        return jsonify({"error": "from / to / before / limit must be numbers"}), 400
+    limit = max(1, min(limit, JOURNAL_QUERY_LIMIT))
+
+    rows = journal.query(request.args.get("device"), request.args.get("kind"),
+                         t0, t1, before, limit)
+    events = [{"seq": seq, "ts": ts, "kind": kind, "name": name, "on": bool(value),
+               "source": source, "detail": detail}
+              for seq, ts, kind, name, value, source, detail in rows]
+    return jsonify({"events": events,
+                    "next": events[-1]["seq"] if len(events) == limit else None})
 
-    # 这里更新 GPIO 或你的硬件控制函数
-    set_main(main_light)
-    set_bedroom(bedroom_light)
-    set_hall(hall_light)
 
+# ================================================================
+# 后端：用电统计
+# ================================================================
+#   /api/usage?period=day&count=7         最近 7 天每天每盏灯亮了多久、多少 Wh
+#   /api/usage?period=hour&count=24&device=main
+USAGE_PERIODS = {"hour": 3600, "day": 86400}
+
+
+@app.route("/api/usage")
+def api_usage():
+    period = request.args.get("period", "day")
+    res = USAGE_PERIODS.get(period)
+    if res is None:
+        return jsonify({"error": "period must be hour or day"}), 400
+    try:
+        count = int(request.args.get("count", 24 if period == "hour" else 7))
+    except ValueError:
+        return jsonify({"error": "count must be an integer"}), 400
+    count = max(1, min(count, USAGE_RESOLUTIONS[res]))
+
+    device = request.args.get("device")
+    if device is not None and device not in registry.devices:
+        return jsonify({"error": "unknown device"}), 404
+    names = [device] if device else list(registry.devices)
+
+    first, devices = usage.report(res, count, names)
     return jsonify({
-        "main": main_light,
-        "bedroom": bedroom_light,
-        "hall": hall_light
+        "period": period,
+        "utc_offset": USAGE_UTC_OFFSET / 3600,   # 天桶按这个时区的零点切分
+        "buckets": [first + i * res for i in range(count)],
+        "devices": devices,
+        "total_wh": round(sum(d["total_wh"] or 0 for d in devices.values()), 2),
     })
 
-# 后端：灯光与模式控制 API
+
 # ================================================================
-@app.route('/action/<cmd>')
-def action(cmd):
-    # 主灯
-    if cmd == 'main_on':
-        GPIO.output(PIN_MAIN, GPIO.HIGH); device_states['main']=True
-    elif cmd == 'main_off':
-        GPIO.output(PIN_MAIN, GPIO.LOW); device_states['main']=False
-
-    # 卧室灯
-    elif cmd == 'bedroom_on':
-        GPIO.output(PIN_BEDROOM, GPIO.HIGH); device_states['bedroom']=True
-    elif cmd == 'bedroom_off':
-        GPIO.output(PIN_BEDROOM, GPIO.LOW); device_states['bedroom']=False
-
-    # 走廊灯
-    elif cmd == 'hall_on':
-        GPIO.output(PIN_HALL, GPIO.HIGH); device_states['hall']=True
-    elif cmd == 'hall_off':
-        GPIO.output(PIN_HALL, GPIO.LOW); device_states['hall']=False
-
-    # All Lights
-    elif cmd == 'all_on':
-        GPIO.output(PIN_MAIN, GPIO.HIGH)
-        GPIO.output(PIN_BEDROOM, GPIO.HIGH)
-        GPIO.output(PIN_HALL, GPIO.HIGH)
-        device_states["main"] = True
-        device_states["bedroom"] = True
-        device_states["hall"] = True
-        device_states["all"] = True
-        device_states["night"] = False
-
-    elif cmd == 'all_off':
-        GPIO.output(PIN_MAIN, GPIO.LOW)
-        GPIO.output(PIN_BEDROOM, GPIO.LOW)
-        GPIO.output(PIN_HALL, GPIO.LOW)
-        device_states["main"] = False
-        device_states["bedroom"] = False
-        device_states["hall"] = False
-        device_states["all"] = False
-
-    # 夜间模式开启：只亮走廊灯（Hall）
-    elif cmd == 'night_on':
-        # 关闭所有灯
-        GPIO.output(PIN_MAIN, GPIO.LOW)
-        GPIO.output(PIN_BEDROOM, GPIO.LOW)
-        GPIO.output(PIN_HALL, GPIO.LOW)
-
-        # 只打开走廊灯（你的夜间指示灯）
-        GPIO.output(PIN_HALL, GPIO.HIGH)
-
-        # 更新状态
-        device_states["main"] = False
-        device_states["bedroom"] = False
-        device_states["hall"] = True   # Hall 灯亮
-        device_states["all"] = False
-        device_states["night"] = True
-
-    # 夜间模式关闭：关掉 Hall 灯
-    elif cmd == 'night_off':
-        GPIO.output(PIN_HALL, GPIO.LOW)
-        device_states["hall"] = False
-        device_states["night"] = False
+# 后端：语音意图（服务端口令匹配，一次请求完成匹配、执行和回复）
+# ================================================================
+# 口令表可以放在 intents.json（SMARTHOME_INTENTS）里修改，不需要改网页：
+#   [{"name": "fan_on", "phrases": ["turn on the fan"], "commands": ["fan_on"], "reply": "Fan on"}, ...]
+# commands / scene 二选一；"query": "climate" 表示查询温湿度，reply 里可以用 {temp} {hum}
+INTENTS_PATH = os.environ.get("SMARTHOME_INTENTS", os.path.join(BASE_DIR, "intents.json"))
+INTENT_FALLBACK_REPLY = "Sorry, I did not understand"
+
+DEFAULT_INTENTS = [
+    {"name": "main_on", "phrases": ["turn on main light"], "commands": ["main_on"],
+     "reply": "Main light is now on"},
+    {"name": "main_off", "phrases": ["turn off main light"], "commands": ["main_off"],
+     "reply": "Main light is now off"},
+    {"name": "bedroom_on", "phrases": ["turn on bedroom light"], "commands": ["bedroom_on"],
+     "reply": "Bedroom light on"},
+    {"name": "bedroom_off", "phrases": ["turn off bedroom light"], "commands": ["bedroom_off"],
+     "reply": "Bedroom light off"},
+    {"name": "hall_on", "phrases": ["turn on hallway light", "turn on hall light"],
+     "commands": ["hall_on"], "reply": "Hallway light on"},
+    {"name": "hall_off", "phrases": ["turn off hallway light", "turn off hall light"],
+     "commands": ["hall_off"], "reply": "Hallway light off"},
+    {"name": "all_on", "phrases": ["turn on all lights"], "commands": ["all_on"],
+     "reply": "All lights are now on"},
+    {"name": "all_off", "phrases": ["turn off all lights"], "commands": ["all_off"],
+     "reply": "All lights are now off"},
+    {"name": "night_on", "phrases": ["night mode", "turn on night mode"], "commands": ["night_on"],
+     "reply": "Night mode activated"},
+    {"name": "night_off", "phrases": ["turn off night mode"], "commands": ["night_off"],
+     "reply": "Night mode off"},
+    {"name": "home", "phrases": ["i am home", "i'm home"], "scene": "home",
+     "reply": "Welcome home, lights are on"},
+    {"name": "leaving", "phrases": ["i am leaving", "i'm leaving"], "scene": "leaving",
+     "reply": "Goodbye, lights turned off"},
+    {"name": "sleep", "phrases": ["i am going to sleep", "i'm going to sleep"], "scene": "sleep",
+     "reply": "Good night, night mode on"},
+    {"name": "climate", "phrases": ["temperature", "humidity"], "query": "climate",
+     "reply": "Current temperature is {temp} degrees, and humidity is {hum} percent."},
+]
+
+
+def normalize_phrase(text):
+    # 小写、去掉标点、合并空白，两端补空格，保证只按整词匹配
+    text = "".join(c if c.isalnum() or c == "'" else " " for c in text.lower())
+    return " " + " ".join(text.split()) + " "
+
+
+class PhraseMatcher:
+    # Aho-Corasick 自动机：所有口令一次建好，匹配一句话只扫描一遍（与口令数量无关）
+
+    def __init__(self, phrases):
+        # phrases: [(口令, 值), ...]
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]   # 节点 -> [(口令长度, 口令序号)]
+        self.values = []
+        for text, value in phrases:
+            node = 0
+            for c in text:
+                nxt = self.goto[node].get(c)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][c] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append((len(text), len(self.values)))
+            self.values.append(value)
+
+        # 按层 BFS 建失败指针，并把失败节点的输出合并进来
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(c, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def matches(self, text):
+        node = 0
+        for c in text:
+            while node and c not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(c, 0)
+            yield from self.out[node]
+
+    def best(self, text):
+        # 只选一个：最长的口令优先，一样长时选口令表里靠前的
+        found = max(self.matches(text), key=lambda m: (m[0], -m[1]), default=None)
+        return self.values[found[1]] if found is not None else None
+
+
+def intent_phrases(intent):
+    # 校验一条口令配置，返回 [(规范化后的口令, intent)]；写错时抛 KeyError / ValueError / TypeError
+    if not isinstance(intent["name"], str) or not isinstance(intent["reply"], str):
+        raise TypeError("name and reply must be strings")
+    if not isinstance(intent["phrases"], list) or not all(isinstance(p, str) for p in intent["phrases"]):
+        raise TypeError("phrases must be a list of strings")
+    cmds = intent.get("commands", [])
+    if not isinstance(cmds, list):
+        raise TypeError("commands must be a list")
+    unknown = [c for c in cmds if c not in COMMANDS]
+    if "scene" in intent and intent["scene"] not in SCENES:
+        unknown.append("scene %s" % intent["scene"])
+    if unknown:
+        raise ValueError("unknown " + ", ".join(map(str, unknown)))
+    return [(normalize_phrase(p), intent) for p in intent["phrases"]]
+
+
+def load_intents(path):
+    intents = DEFAULT_INTENTS
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            intents = json.load(f)
+    phrases = []
+    for intent in intents:
+        # 写错的条目、设备配置里没有的场景 / 命令（例如自定义 devices.json 后的默认口令）跳过
+        try:
+            phrases.extend(intent_phrases(intent))
+        except (KeyError, ValueError, TypeError) as e:
+            name = intent.get("name") if isinstance(intent, dict) else intent
+            print("[INTENT ERROR] skip %r: %s" % (name, e), flush=True)
+    return PhraseMatcher(phrases)
+
+
+intent_matcher = load_intents(INTENTS_PATH)
+
+
+@app.route("/api/intent", methods=["POST"])
+def api_intent():
+    body = request.get_json(silent=True)
+    text = body.get("text") if isinstance(body, dict) else None
+    if not isinstance(text, str):
+        return jsonify({"error": "expected {\"text\": \"...\"}"}), 400
+
+    intent = intent_matcher.best(normalize_phrase(text))
+    if intent is None:
+        return jsonify({"intent": None, "reply": INTENT_FALLBACK_REPLY, "state": None})
+
+    cmds = SCENES[intent["scene"]] if "scene" in intent else intent.get("commands", [])
+    if cmds:
+        state = run_commands(cmds, "intent")   # 一次加锁执行完
+    else:
+        state = state_payload()
+    reply = intent["reply"]
+    if intent.get("query") == "climate":
+        sample = latest_sample
+        if sample is None:
+            reply = "The sensor has no reading yet"
+        else:
+            reply = reply.format(temp=sample.temp, hum=sample.hum)
+    return jsonify({"intent": intent["name"], "reply": reply, "state": state})
 
-    return ("OK", 200)
 
 @app.route("/state")
 def state():
-    return jsonify(device_states)
+    return cached_json("state", (state_version,), lambda: device_states)
+
+
+# ================================================================
+# 后端：SSE 事件流（替代网页每 500ms 轮询 /state）
+# ================================================================
+SSE_KEEPALIVE = 15.0   # 没有事件时每 15 秒发一行注释，防止连接被断开
+
+
+def sse_format(seq, kind, payload):
+    return f"id: {seq}\nevent: {kind}\ndata: {payload}\n\n"
+
+
+def sse_snapshot():
+    # 新连接（或错过太多事件）时先发完整的当前状态
+    with hub.cond:
+        seq = hub.seq
+        chunks = [sse_format(seq, "state", dump_json(state_payload()))]
+    sample = latest_sample
+    if sample is not None:
+        chunks.append(sse_format(seq, "sample", dump_json(
+            {"temp": sample.temp, "hum": sample.hum, "ts": sample.ts})))
+    chunks.append(sse_format(seq, "alarm", dump_json(alarms.payload(sample))))
+    return seq, "".join(chunks)
+
+
+def sse_next(seq, pending):
+    # 返回 (新的 seq, 要发送的文本)；pending 为 None 说明错过太多，改发快照
+    if pending is None:
+        return sse_snapshot()
+    if not pending:
+        return seq, ""
+    return pending[-1][0], "".join(sse_format(*e) for e in pending)
+
+
+def sse_resume(last_id):
+    # 带 Last-Event-ID 重连时补发错过的事件，否则从快照开始
+    if last_id.isdigit():
+        return sse_next(int(last_id), hub.since(int(last_id)))
+    return sse_snapshot()
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+
+@app.route("/events")
+def events():
+    last_id = request.headers.get("Last-Event-ID", "")
+
+    def stream():
+        metrics["sse_streams"] += 1
+        try:
+            seq, chunk = sse_resume(last_id)
+            yield "retry: 3000\n\n" + chunk
+            while True:
+                pending = hub.wait(seq, SSE_KEEPALIVE)
+                if pending == []:
+                    yield ": keepalive\n\n"
+                    continue
+                seq, chunk = sse_next(seq, pending)
+                yield chunk
+        finally:
+            metrics["sse_streams"] -= 1
+
+    return Response(stream(), mimetype="text/event-stream", headers=SSE_HEADERS)
 
 
 @app.route("/cpu_temp")
 def cpu_temp():
+    # 读系统监控的缓存快照，不碰 sysfs
+    t = read_cpu_temp()
+    # 温度值本身就是版本号：没变化就是 304
+    value = t if t is not None else -1
+    return cached_json("cpu_temp", (value, alarms.system_version), lambda: {
+        "temp": value, "alarms": alarms.system_messages()})
+
+
+@app.route("/api/system")
+def api_system():
+    # 完整快照（所有温区、频率、降频标志、负载）+ 最近 5 分钟历史
+    snapshot = monitor.snapshot
+    if snapshot is None:
+        return jsonify({"error": "system monitor not ready"}), 503
+    return cached_json("system", (snapshot["seq"], alarms.system_version), lambda: dict(
+        snapshot, history=monitor.history_columns(),
+        alarms={n: alarms.active[n] for n in sorted(alarms.system)},
+        messages=alarms.system_messages()))
+
+# ================================================================
+# 后端：WebSocket 控制通道（/ws）
+# ================================================================
+# 客户端发送 {"id": "c1", "commands": [...]} 或 {"id": "c2", "scene": "home"}，
+# 服务端回 {"type": "ack", "id": "c1", "ok": true, "version": 12, "state": {...}}；
+# 任何客户端引起的状态变化都以 {"type": "state", "state": {...}} 广播给所有连接。
+# ASGI 模式原生支持；线程模式需要安装 flask-sock
+def ws_handle(text):
+    try:
+        msg = json.loads(text)
+    except (ValueError, TypeError):
+        msg = None
+    if not isinstance(msg, dict):
+        return dump_json({"type": "ack", "id": None, "ok": False, "error": "bad message"})
+    msg_id = msg.get("id")
+    if msg.get("type") == "ping":
+        return dump_json({"type": "pong", "id": msg_id})
+
+    if not isinstance(msg.get("scene", ""), str):
+        return dump_json({"type": "ack", "id": msg_id, "ok": False, "error": "expected commands or scene"})
+    if "scene" in msg:
+        cmds = SCENES.get(msg["scene"])
+        if cmds is None:
+            return dump_json({"type": "ack", "id": msg_id, "ok": False,
+                              "error": "unknown scene: %s" % msg["scene"]})
+    else:
+        cmds = msg.get("commands")
+        if not isinstance(cmds, list) or not all(isinstance(c, str) for c in cmds):
+            return dump_json({"type": "ack", "id": msg_id, "ok": False,
+                              "error": "expected commands or scene"})
     try:
-        with open("/sys/class/thermal/thermal_zone0/temp") as f:
-            t = int(f.read()) / 1000
-        return jsonify({"temp": round(t, 1)})
-    except:
-        return jsonify({"temp": -1})
+        state = run_commands(cmds, "ws")
+    except ValueError as e:
+        return dump_json({"type": "ack", "id": msg_id, "ok": False, "error": str(e)})
+    return dump_json({"type": "ack", "id": msg_id, "ok": True,
+                      "version": state["version"], "state": state})
+
+
+def ws_snapshot():
+    with hub.cond:
+        return hub.seq, dump_json({"type": "state", "state": state_payload()})
+
+
+def ws_next(seq, pending):
+    # 只转发 state 事件；一批里有多次变化时只发最后一次
+    if pending is None:
+        return ws_snapshot()
+    if not pending:
+        return seq, None
+    states = [e for e in pending if e[1] == "state"]
+    text = '{"type":"state","state":%s}' % states[-1][2] if states else None
+    return pending[-1][0], text
+
+
+if Sock is not None:
+    sock = Sock(app)
+
+    @sock.route("/ws")
+    def ws_channel(ws):
+        # 接收线程处理命令并回 ack；另一个线程等事件并广播，两边共用一把发送锁
+        send_lock = threading.Lock()
+        closed = threading.Event()
+        # 小帧立即发出，避免 Nagle + 延迟 ACK 给每次 ack 加上约 40ms
+        ws.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def push():
+            seq, text = ws_snapshot()
+            try:
+                while not closed.is_set():
+                    if text:
+                        with send_lock:
+                            ws.send(text)
+                    seq, text = ws_next(seq, hub.wait(seq, SSE_KEEPALIVE))
+            except ConnectionClosed:
+                pass
+
+        threading.Thread(target=push, daemon=True).start()
+        try:
+            while True:
+                reply = ws_handle(ws.receive())
+                with send_lock:
+                    ws.send(reply)
+        except ConnectionClosed:
+            pass
+        finally:
+            closed.set()
 
 # ================================================================
 # 首页
 # ================================================================
+# 模板里只有静态资源地址，启动时渲染一次并预压缩，之后每次请求直接发送
+with app.app_context(), span("template"), BootStep("page"):
+    page_asset = make_asset(
+        render_template_string(
+            PAGE_HTML, chart_js=asset_url("chart.umd.min.js")
+        ).encode("utf-8"),
+        "text/html; charset=utf-8"
+    )
+
+
 @app.route('/')
 def index():
-    return render_template_string(PAGE_HTML)
+    # HTML 每次都要用 ETag 验证一下，这样更新程序后手机能拿到新页面
+    return send_asset(page_asset, "no-cache")
+
+# ================================================================
+# 运行指标：每个路由的请求数 / 延迟直方图 + 传感器、GPIO、队列状态
+# ================================================================
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+
+
+class RouteStats:
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.status = [0] * len(STATUS_CLASSES)
+
+
+@app.route("/metrics")
+def metrics_page():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE,
+                    headers={"Cache-Control": "no-store"})
+
+
+# 按路由模板预先分配统计对象（标签数量固定）；后面还有路由要注册，
+# 所以在模块末尾所有路由都注册完之后才调用 allocate_route_stats()
+route_stats = {"<unmatched>": RouteStats()}
+
+
+def allocate_route_stats():
+    for rule in app.url_map.iter_rules():
+        route_stats.setdefault(rule.rule, RouteStats())
+
+
+@app.before_request
+def metrics_start():
+    request.environ["smarthome.started"] = time.perf_counter()
+
+
+@app.after_request
+def metrics_finish(response):
+    started = request.environ.get("smarthome.started")
+    if started is not None:
+        rule = request.url_rule
+        stats = route_stats.get(rule.rule if rule is not None else "<unmatched>")
+        if stats is not None:
+            stats.latency.observe(time.perf_counter() - started)
+            stats.status[min(max(response.status_code // 100, 1), 5) - 1] += 1
+    return response
+
+
+def prom_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics():
+    out = []
+
+    def metric(name, kind, help_text, samples):
+        # samples: [(标签字符串, 数值), ...]
+        out.append("# HELP %s %s" % (name, help_text))
+        out.append("# TYPE %s %s" % (name, kind))
+        for labels, value in samples:
+            out.append("%s%s %s" % (name, labels, value))
+
+    def histogram(name, help_text, series):
+        # series: [(标签字符串（不含花括号）, Histogram), ...]
+        out.append("# HELP %s %s" % (name, help_text))
+        out.append("# TYPE %s histogram" % name)
+        for labels, h in series:
+            counts = list(h.counts)   # 先拷贝一份，保证同一组 bucket 自洽
+            sep = "," if labels else ""
+            total = 0
+            for le, n in zip(h.buckets + ("+Inf",), counts):
+                total += n
+                out.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, le, total))
+            labels = "{%s}" % labels if labels else ""
+            out.append("%s_sum%s %.6f" % (name, labels, h.sum))
+            out.append("%s_count%s %d" % (name, labels, total))
+
+    # 路由延迟直方图
+    histogram("smarthome_http_request_duration_seconds", "Request latency by route",
+              [('route="%s"' % prom_label(route), stats.latency)
+               for route, stats in route_stats.items()])
+    metric("smarthome_http_requests_total", "counter", "Requests by route and status class",
+           [('{route="%s",status="%s"}' % (prom_label(route), cls), n)
+            for route, stats in route_stats.items()
+            for cls, n in zip(STATUS_CLASSES, stats.status) if n])
+
+    # 传感器
+    sample = latest_sample
+    metric("smarthome_dht_reads_total", "counter", "DHT22 read attempts",
+           [("", metrics["dht_attempts"])])
+    metric("smarthome_dht_failures_total", "counter", "DHT22 reads that raised RuntimeError",
+           [("", metrics["dht_failures"])])
+    metric("smarthome_dht_errors_total", "counter", "DHT22 reads that raised other errors",
+           [("", metrics["dht_errors"])])
+    metric("smarthome_dht_retries_total", "counter", "DHT22 reads following a failed read",
+           [("", metrics["dht_retries"])])
+    metric("smarthome_temp_fallback_total", "counter", "/api/temp responses served with fallback values",
+           [("", metrics["temp_fallback"])])
+    metric("smarthome_sample_age_seconds", "gauge", "Age of the latest DHT22 sample",
+           [("", "%.3f" % sample_age(sample) if sample is not None else "NaN")])
+    metric("smarthome_sample_seq", "counter", "Successful DHT22 samples",
+           [("", sample.seq if sample is not None else 0)])
+    metric("smarthome_room_sample_age_seconds", "gauge", "Age of the latest sample by sensor",
+           [('{sensor="%s"}' % prom_label(s.id),
+             "%.3f" % sample_age(s.latest) if s.latest is not None else "NaN") for s in sensors])
+
+    # 报警 / 规则
+    metric("smarthome_alarm_active", "gauge", "Whether any room climate alarm rule is active",
+           [("", int(alarm_active))])
+    metric("smarthome_system_alarm_active", "gauge", "Whether any system alarm rule is active",
+           [("", int(any(alarms.active[n] for n in alarms.system)))])
+    metric("smarthome_alarm_activations_total", "counter", "Alarm activations by rule",
+           [('{rule="%s"}' % prom_label(name), n) for name, n in alarms.activations.items()])
+    metric("smarthome_rule_fires_total", "counter", "Automation rule executions",
+           [('{rule="%s"}' % prom_label(name), n) for name, n in rules.fires.items()])
+
+    # CPU / 温度
+    system = monitor.snapshot or {"zones": [], "freq_mhz": [], "throttled": None, "load": None}
+    metric("smarthome_thermal_zone_celsius", "gauge", "Thermal zone temperatures",
+           [('{zone="%s",type="%s"}' % (prom_label(z["zone"]), prom_label(z["type"])), z["temp"])
+            for z in system["zones"]])
+    metric("smarthome_cpu_freq_mhz", "gauge", "Current CPU frequency by core",
+           [('{cpu="%d"}' % i, f) for i, f in enumerate(system["freq_mhz"])])
+    if system["throttled"] is not None:
+        metric("smarthome_throttled_flags", "gauge", "Raspberry Pi firmware throttling flags",
+               [("", system["throttled"])])
+    if system["load"]:
+        metric("smarthome_load1", "gauge", "1-minute load average", [("", system["load"][0])])
+
+    # GPIO
+    metric("smarthome_gpio_writes_total", "counter", "Digital output writes by pin",
+           [('{pin="%d"}' % pin, n) for pin, n in gpio_writes.items()])
+    metric("smarthome_expander_writes_total", "counter", "I2C expander port writes",
+           [('{expander="%s"}' % prom_label(name), p.writes) for name, p in registry.ports.items()])
+
+    # 硬件 I/O 线程
+    metric("smarthome_hw_queue_depth", "gauge", "Pending pin/port writes and hardware jobs",
+           [("", worker.depth())])
+    metric("smarthome_hw_queue_max_depth", "gauge", "Largest hardware queue depth seen",
+           [("", worker.max_depth)])
+    metric("smarthome_hw_writes_submitted_total", "counter", "Pin and port writes submitted",
+           [("", worker.submitted)])
+    metric("smarthome_hw_writes_coalesced_total", "counter",
+           "Writes superseded by a later write before the flush", [("", worker.coalesced)])
+    metric("smarthome_hw_errors_total", "counter", "Failed hardware writes", [("", worker.errors)])
+    histogram("smarthome_hw_service_seconds", "Time to service one batch of hardware work",
+              [("", worker.service)])
+    histogram("smarthome_hw_sensor_read_seconds", "Time to service one sensor read",
+              [("", worker.read_service)])
+
+    # 线程 / 队列
+    metric("smarthome_threads", "gauge", "Live Python threads",
+           [("", threading.active_count())])
+    metric("smarthome_scheduler_queue", "gauge", "Pending scheduler tasks",
+           [("", len(scheduler.heap))])
+    metric("smarthome_store_pending", "gauge", "Samples waiting for the next database flush",
+           [("", len(store.pending))])
+    metric("smarthome_journal_pending", "gauge", "Journal events waiting for the next group commit",
+           [("", len(journal.pending))])
+    metric("smarthome_journal_events_total", "counter", "Journal events committed",
+           [("", journal.events)])
+    metric("smarthome_journal_commits_total", "counter", "Journal group commits",
+           [("", journal.commits)])
+    metric("smarthome_event_backlog", "gauge", "Events kept for SSE resume",
+           [("", len(hub.events))])
+    metric("smarthome_sse_clients", "gauge", "Open push connections (/events, ASGI /ws)",
+           [("", metrics["sse_streams"] + len(hub.listeners))])
+    if blocking_pool is not None:
+        metric("smarthome_blocking_queue", "gauge", "Requests waiting for the ASGI blocking pool",
+               [("", blocking_pool._work_queue.qsize())])
+    return "\n".join(out) + "\n"
+
+# ================================================================
+# 管理接口：采样分析器 / 追踪开关（需要 SMARTHOME_ADMIN_TOKEN）
+# ================================================================
+# 没设置令牌时这些接口一律 404；请求头 X-Admin-Token 或 ?token= 携带令牌
+#   curl -X POST -H "X-Admin-Token: $T" "https://pi:5000/admin/profile?seconds=30"
+#   curl -H "X-Admin-Token: $T" https://pi:5000/admin/profile > out.folded
+#   flamegraph.pl out.folded > out.svg
+ADMIN_TOKEN = os.environ.get("SMARTHOME_ADMIN_TOKEN", "")
+PROFILE_MAX_SECONDS = 120
+PROFILE_INTERVAL = 0.005   # 每 5ms 采一次所有线程的调用栈
+
+
+def admin_denied():
+    if not ADMIN_TOKEN:
+        return ("Not Found", 404)
+    token = request.headers.get("X-Admin-Token") or request.args.get("token", "")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return ("Forbidden", 403)
+    return None
+
+
+class SamplingProfiler:
+    # 只在分析期间存在一个线程：定时抓取 sys._current_frames()，
+    # 把调用栈折叠成 "线程;函数 (文件:行);..." 计数（flamegraph.pl / speedscope 可直接读取）
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stacks = {}
+        self.result = None
+        self.samples = 0
+        self.until = 0.0
+
+    def start(self, seconds, interval):
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.stacks = {}
+            self.samples = 0
+            self.until = time.monotonic() + seconds
+            self.thread = threading.Thread(target=self.run, args=(interval,),
+                                           name="profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def run(self, interval):
+        me = threading.get_ident()
+        while time.monotonic() < self.until:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(interval)
+        with self.lock:
+            self.result = "".join("%s %d\n" % kv for kv in sorted(self.stacks.items()))
+            self.thread = None
+
+    def status(self):
+        return {
+            "running": self.thread is not None,
+            "remaining": round(max(0.0, self.until - time.monotonic()), 1),
+            "samples": self.samples,
+            "ready": self.result is not None,
+        }
+
+
+profiler = SamplingProfiler()
+
+
+@app.route("/admin/profile", methods=["GET", "POST"])
+def admin_profile():
+    denied = admin_denied()
+    if denied:
+        return denied
+    if request.method == "POST":
+        try:
+            seconds = min(float(request.args.get("seconds", 10)), PROFILE_MAX_SECONDS)
+            interval = max(float(request.args.get("interval", PROFILE_INTERVAL)), 0.001)
+        except ValueError:
+            return jsonify({"error": "seconds / interval must be numbers"}), 400
+        if not profiler.start(seconds, interval):
+            return jsonify(dict(profiler.status(), error="profiler already running")), 409
+        return jsonify(profiler.status()), 202
+
+    status = profiler.status()
+    if status["running"] or not status["ready"]:
+        return jsonify(status), 202 if status["running"] else 404
+    return Response(profiler.result, mimetype="text/plain",
+                    headers={"Content-Disposition": "attachment; filename=profile.folded",
+                             "Cache-Control": "no-store"})
+
+
+@app.route("/admin/trace", methods=["GET", "POST"])
+def admin_trace():
+    global tracing
+    denied = admin_denied()
+    if denied:
+        return denied
+    if request.method == "POST":
+        tracing = request.args.get("enable", "1") not in ("0", "false", "off")
+        if request.args.get("reset"):
+            with trace_lock:
+                span_stats.clear()
+    with trace_lock:
+        spans = {name: {"count": n, "total_ms": round(total * 1000, 3),
+                        "mean_ms": round(total * 1000 / n, 3), "max_ms": round(peak * 1000, 3)}
+                 for name, (n, total, peak) in span_stats.items()}
+    return jsonify({"enabled": tracing, "spans": spans})
+
+
+@app.before_request
+def trace_start():
+    if tracing:
+        trace_local.spans = []
+
+
+@app.after_request
+def trace_finish(response):
+    spans = getattr(trace_local, "spans", None)
+    if spans is not None:
+        trace_local.spans = None
+        totals = {}
+        for name, elapsed in spans:
+            totals[name] = totals.get(name, 0.0) + elapsed
+        if totals:
+            response.headers["Server-Timing"] = ", ".join(
+                "%s;dur=%.3f" % (name, total * 1000) for name, total in totals.items())
+    return response
+
+# ================================================================
+# 就绪检查：/ready
+# ================================================================
+# 网页和 /state 在模块导入完成后就能用；其余子系统在后台就绪。
+# 全部就绪返回 200，否则返回 503，方便 systemd / 反向代理做健康检查
+
+
+def warm_up():
+    # 后台提前导入二维码库，第一次打开 /qrcode 时就不用再等；再压缩静态资源
+    try:
+        import qrcode.image.svg
+        mark_ready("qrcode")
+    except ImportError as e:
+        mark_ready("qrcode", e)
+    for asset in static_assets.values():
+        compress_asset(asset)
+    mark_ready("assets")
+
+
+@app.route("/ready")
+def ready():
+    now = time.monotonic() - BOOT_STARTED
+    subsystems = {name: {"ready": ready_at[name] is not None, "seconds": ready_at[name],
+                         "error": ready_errors.get(name)}
+                  for name in SUBSYSTEMS}
+    ok = all(s["ready"] for s in subsystems.values())
+    resp = jsonify({"ready": ok, "uptime": round(now, 3), "subsystems": subsystems,
+                    "boot_steps": boot_steps})
+    resp.status_code = 200 if ok else 503
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+allocate_route_stats()   # 必须在最后一个 @app.route 之后
+mark_ready("http")
+
+# ================================================================
+# ASGI / asyncio 服务模式（python smarthome.py --asgi，需要 uvicorn）
+# ================================================================
+# SSE 长连接直接在事件循环里处理，每个连接只是一个协程，不占线程；
+# 只读内存的接口在事件循环里直接调用 Flask 处理；
+# 会碰硬件 / 数据库 / 二维码编码的接口放到固定大小的线程池里执行
+ASGI_BLOCKING_WORKERS = 4
+ASGI_INLINE_PATHS = {"/", "/state", "/api/states", "/api/temp", "/cpu_temp", "/api/system", "/ready"}
+ASGI_INLINE_PREFIXES = ("/static/", "/api/rooms")
+
+blocking_pool = None   # 启动 ASGI 模式时才创建
+
+
+def asgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1")
+        value = value.decode("latin-1")
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+def call_wsgi(environ):
+    captured = []
+
+    def start_response(status, headers, exc_info=None):
+        captured[:] = [int(status.split(" ", 1)[0]), headers]
+
+    result = app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    status, headers = captured
+    return status, headers, body
+
+
+async def asgi_read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def asgi_events(scope, receive, send):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+
+    def notify():
+        loop.call_soon_threadsafe(wake.set)
+
+    async def wait_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    last_id = ""
+    for name, value in scope["headers"]:
+        if name == b"last-event-id":
+            last_id = value.decode("latin-1")
+
+    hub.listeners.add(notify)
+    disconnected = asyncio.ensure_future(wait_disconnect())
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream")]
+                       + [(k.lower().encode(), v.encode()) for k, v in SSE_HEADERS.items()],
+        })
+        seq, chunk = sse_resume(last_id)
+        await send({"type": "http.response.body",
+                    "body": ("retry: 3000\n\n" + chunk).encode(), "more_body": True})
+
+        while True:
+            wake.clear()
+            pending = hub.since(seq)
+            if pending == []:
+                woken = asyncio.ensure_future(wake.wait())
+                done, _ = await asyncio.wait({woken, disconnected}, timeout=SSE_KEEPALIVE,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+                if disconnected in done:
+                    break
+                if not done:
+                    await send({"type": "http.response.body",
+                                "body": b": keepalive\n\n", "more_body": True})
+                continue
+            seq, chunk = sse_next(seq, pending)
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+    finally:
+        hub.listeners.discard(notify)
+        disconnected.cancel()
+
+
+async def asgi_websocket(scope, receive, send):
+    if (await receive())["type"] != "websocket.connect":
+        return
+    if scope["path"] != "/ws":
+        await send({"type": "websocket.close", "code": 1008})
+        return
+    await send({"type": "websocket.accept"})
+
+    import asyncio
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+
+    def notify():
+        loop.call_soon_threadsafe(wake.set)
+
+    hub.listeners.add(notify)
+    incoming = asyncio.ensure_future(receive())
+    try:
+        seq, text = ws_snapshot()
+        await send({"type": "websocket.send", "text": text})
+        while True:
+            wake.clear()
+            seq, text = ws_next(seq, hub.since(seq))
+            if text:
+                await send({"type": "websocket.send", "text": text})
+            woken = asyncio.ensure_future(wake.wait())
+            done, _ = await asyncio.wait({incoming, woken}, return_when=asyncio.FIRST_COMPLETED)
+            woken.cancel()
+            if incoming not in done:
+                continue
+            message = incoming.result()
+            if message["type"] == "websocket.disconnect":
+                break
+            text = message.get("text") or (message.get("bytes") or b"").decode("utf-8", "replace")
+            # 命令会写硬件，放到线程池里执行，不阻塞事件循环
+            reply = await loop.run_in_executor(blocking_pool, ws_handle, text)
+            await send({"type": "websocket.send", "text": reply})
+            incoming = asyncio.ensure_future(receive())
+    finally:
+        hub.listeners.discard(notify)
+        incoming.cancel()
+
+
+async def asgi_lifespan(receive, send):
+    global blocking_pool
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            blocking_pool = ThreadPoolExecutor(ASGI_BLOCKING_WORKERS,
+                                               thread_name_prefix="blocking")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            store.flush()
+            blocking_pool.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await asgi_lifespan(receive, send)
+        return
+    if scope["type"] == "websocket":
+        await asgi_websocket(scope, receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"]
+    if path == "/events":
+        await asgi_events(scope, receive, send)
+        return
+
+    environ = asgi_environ(scope, await asgi_read_body(receive))
+    if path in ASGI_INLINE_PATHS or path.startswith(ASGI_INLINE_PREFIXES):
+        status, headers, body = call_wsgi(environ)
+    else:
+        import asyncio
+        loop = asyncio.get_running_loop()
+        status, headers, body = await loop.run_in_executor(blocking_pool, call_wsgi, environ)
+
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    })
+    await send({"type": "http.response.body", "body": body})
 
 # ================================================================
 # 主启动入口
 # ================================================================
 if __name__ == '__main__':
     try:
-        app.run(
-            host='0.0.0.0',
-            port=5000, 
-            debug=False，
-            ssl_context=('cert.pem', 'key.pem')
-        )
+        if "--asgi" in sys.argv:
+            import uvicorn
+            uvicorn.run(
+                asgi_app,
+                host='0.0.0.0',
+                port=5000,
+                ssl_certfile='cert.pem',
+                ssl_keyfile='key.pem'
+            )
+        else:
+            app.run(
+                host='0.0.0.0',
+                port=5000, 
+                debug=False,
+                ssl_context=('cert.pem', 'key.pem')
+            )
     finally:
-        GPIO.cleanup()
+        worker.call(hw.cleanup)   # 等待之前排队的写入完成后再释放 GPIO
 #https://192.168.137.28:5000/
\ No newline at end of file
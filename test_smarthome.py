@@ -0,0 +1,421 @@
+# ================================================================
+# 单元测试（模拟硬件，不需要树莓派）：python -m pytest -q test_smarthome.py
+# ================================================================
+# 导入 smarthome 之前先指定模拟后端和临时数据库；配置文件指向不存在的路径，
+# 保证用的是内置默认配置，不受本机 rules.json / devices.json 影响
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+TMP_DIR = tempfile.mkdtemp(prefix="smarthome-test-")
+os.environ["SMARTHOME_BACKEND"] = "sim"
+os.environ["SMARTHOME_DB"] = os.path.join(TMP_DIR, "test.db")
+for name in ("RULES", "DEVICES", "SENSORS", "INTENTS"):
+    os.environ["SMARTHOME_" + name] = os.path.join(TMP_DIR, name.lower() + ".json")
+
+import pytest
+
+import smarthome
+
+
+# ================================================================
+# 时间轮 / 规则
+# ================================================================
+def wait_for(event, timeout=2.0):
+    return event.wait(timeout)
+
+
+def test_timer_wheel_never_fires_early():
+    wheel = smarthome.TimerWheel(8, 0.05)
+    fired = threading.Event()
+    started = time.monotonic()
+    wheel.add(0.12, lambda: fired.set())
+    assert wait_for(fired)
+    assert time.monotonic() - started >= 0.12
+
+
+def test_timer_wheel_longer_than_one_turn():
+    # 8 槽 × 0.05 秒 = 0.4 秒一圈，0.5 秒的定时要多转一圈
+    wheel = smarthome.TimerWheel(8, 0.05)
+    fired = threading.Event()
+    started = time.monotonic()
+    wheel.add(0.5, lambda: fired.set())
+    assert wait_for(fired)
+    assert time.monotonic() - started >= 0.5
+
+
+def test_timer_wheel_cancel():
+    wheel = smarthome.TimerWheel(8, 0.05)
+    cancelled = threading.Event()
+    fired = threading.Event()
+    wheel.cancel(wheel.add(0.1, lambda: cancelled.set()))
+    wheel.add(0.2, lambda: fired.set())
+    assert wait_for(fired)
+    assert not cancelled.is_set()
+
+
+@pytest.mark.parametrize("when", [
+    {"sensor": "humidity", "op": ">", "value": 1},   # 字段拼错
+    {"sensor": "temp", "op": ">"},                    # 缺少 value
+    {"sensor": "temp", "op": "~", "value": 1},        # 未知比较符
+    {"sensor": "hum", "trend": "up"},                 # 未知趋势
+    {"device": "attic", "is": True},                  # 未知设备
+    {"sensor": "temp", "op": ">", "value": "hot"},    # value 不是数字
+    {"sensor": "temp", "op": ">", "value": 1, "for": "abc"},
+    {"sensor": "hum", "trend": "rising", "window": 0},
+])
+def test_rule_engine_rejects_bad_rules(when):
+    engine = smarthome.RuleEngine([])
+    with pytest.raises((KeyError, ValueError, TypeError)):
+        engine.add({"name": "bad", "when": when, "then": ["hall_on"]})
+    assert "bad" not in engine.state
+
+
+def test_rule_engine_indexes_and_fires_on_edge():
+    engine = smarthome.RuleEngine([])
+    engine.add({"name": "hot", "when": {"sensor": "temp", "op": ">", "value": 30}, "then": ["hall_on"]})
+    fired = []
+    engine.fire = fired.append
+    sample = lambda t: smarthome.Sample(t, 50.0, time.time(), time.monotonic(), 1, "living")
+    engine.on_sample(sample(29.0))
+    engine.on_sample(sample(31.0))
+    engine.on_sample(sample(32.0))   # 条件一直成立，不重复触发
+    engine.on_sample(sample(29.0))
+    engine.on_sample(sample(31.0))
+    assert [r["name"] for r in fired] == ["hot", "hot"]
+    assert list(engine.by_sensor) == ["temp"]
+
+
+
+def test_rule_engine_converts_numbers_at_load():
+    engine = smarthome.RuleEngine([])
+    engine.add({"name": "hot", "when": {"sensor": "temp", "op": ">", "value": "30", "for": "0"},
+                "then": ["hall_on"]})
+    fired = []
+    engine.fire = fired.append
+    engine.on_sample(smarthome.Sample(31.0, 50.0, time.time(), time.monotonic(), 1, "living"))
+    assert [r["when"]["value"] for r in fired] == [30.0]
+
+
+def test_rule_engine_skips_duplicates_and_bad_entries():
+    rule = {"name": "hot", "when": {"sensor": "temp", "op": ">", "value": 30}, "then": ["hall_on"]}
+    engine = smarthome.RuleEngine([rule, dict(rule, then=["main_on"]), ["not", "a", "rule"]])
+    assert list(engine.state) == ["hot"]
+    assert [r["then"] for r in engine.by_sensor["temp"]] == [["hall_on"]]
+
+# ================================================================
+# 报警引擎：室内报警和系统报警分开
+# ================================================================
+def test_system_alarm_does_not_raise_room_alarm(monkeypatch):
+    monkeypatch.setattr(smarthome, "alarm_active", False)
+    engine = smarthome.AlarmEngine(smarthome.ALARM_RULES, None)
+    for seq in range(3):
+        engine.on_sample(smarthome.SystemSample(50.0, 0, 1, time.time(), time.monotonic(), seq))
+    assert engine.active["undervoltage"] and not smarthome.alarm_active
+    payload = engine.payload(None)
+    assert payload["messages"] == [] and payload["system"] == engine.system_messages() != []
+
+    for seq in range(3):
+        engine.on_sample(smarthome.Sample(35.0, 50.0, time.time(), time.monotonic(), seq, "main"))
+    assert smarthome.alarm_active
+    assert engine.payload(None)["messages"] == ["High Temperature! Current: 35.0°C"]
+
+
+# ================================================================
+# 传感器配置
+# ================================================================
+def test_load_sensors_falls_back_to_default(tmp_path):
+    path = tmp_path / "sensors.json"
+    path.write_text(json.dumps([{"id": "x", "kind": "am2302", "pin": 4}, "y"]))
+    loaded = smarthome.load_sensors(str(path))
+    assert [(s.id, s.primary) for s in loaded] == [("main", True)]
+
+
+def test_load_sensors_first_valid_entry_is_primary(tmp_path):
+    path = tmp_path / "sensors.json"
+    path.write_text(json.dumps([{"id": "x"}, {"id": "living", "pin": 4}, {"id": "bed", "pin": 17}]))
+    loaded = smarthome.load_sensors(str(path))
+    assert [(s.id, s.primary) for s in loaded] == [("living", True), ("bed", False)]
+
+
+# ================================================================
+# 设备注册表：位图命令
+# ================================================================
+def run(registry, mask, *cmds):
+    for c in cmds:
+        mask = smarthome.apply_command(mask, registry.commands[c])
+    return registry.states(mask)
+
+
+@pytest.fixture
+def registry():
+    return smarthome.DeviceRegistry(smarthome.DEFAULT_DEVICES)
+
+
+def test_switch_commands(registry):
+    states = run(registry, 0, "main_on", "bedroom_on", "bedroom_off")
+    assert states["main"] and not states["bedroom"] and not states["hall"]
+
+
+def test_toggle_device(registry):
+    assert run(registry, 0, "toggle_main")["main"]
+    assert not run(registry, 0, "toggle_main", "toggle_main")["main"]
+
+
+def test_toggle_group_turns_everything_on_unless_all_on(registry):
+    states = run(registry, 0, "main_on", "toggle_all")
+    assert states["main"] and states["bedroom"] and states["hall"] and states["all"]
+    states = run(registry, 0, "all_on", "toggle_all")
+    assert not any(states[d] for d in registry.devices)
+
+
+def test_night_mode_leaves_only_hall_on(registry):
+    states = run(registry, 0, "all_on", "night_on")
+    assert states == {"main": False, "bedroom": False, "hall": True, "night": True, "all": False}
+    assert not run(registry, 0, "night_on", "toggle_night")["night"]
+
+
+def test_all_on_ends_modes(registry):
+    states = run(registry, 0, "night_on", "all_on")
+    assert not states["night"] and states["all"]
+
+
+def test_iter_bits():
+    assert list(smarthome.iter_bits(0b101001)) == [0, 3, 5]
+    assert list(smarthome.iter_bits(0)) == []
+
+
+def test_registry_rejects_bad_config():
+    devices = [{"name": "a", "pin": 1}, {"name": "a", "pin": 2}]
+    with pytest.raises(ValueError):
+        smarthome.DeviceRegistry({"devices": devices})
+    with pytest.raises(ValueError):
+        smarthome.DeviceRegistry({"devices": [{"name": "a", "pin": 1}], "scenes": {"x": ["b_on"]}})
+
+
+def test_expander_channels_map_to_port_bits():
+    registry = smarthome.DeviceRegistry({
+        "expanders": [{"id": "relays", "chip": "pcf8574", "address": "0x20"}],
+        "devices": [{"name": "a", "pin": 5},
+                    {"name": "b", "expander": "relays", "channel": 3},
+                    {"name": "c", "expander": "relays", "channel": 0}],
+    })
+    port = registry.ports["relays"]
+    assert registry.native_mask == 0b001
+    assert port.devmask == 0b110
+    assert port.channel_bits == {1: 1 << 3, 2: 1 << 0}
+
+
+
+def test_slow_sensor_read_does_not_delay_writes():
+    worker = smarthome.HardwareWorker(4)
+    worker.start(lambda: None)
+    release = threading.Event()
+    reader = threading.Thread(target=worker.read, args=(release.wait,), daemon=True)
+    reader.start()
+    pin = smarthome.registry.devices["hall"].pin
+    want = not smarthome.hw.pins.get(pin)
+    worker.write_pins([pin], [want])
+    deadline = time.monotonic() + 1.0
+    while smarthome.hw.pins.get(pin) != want and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert smarthome.hw.pins.get(pin) == want
+    assert reader.is_alive()             # 读取还卡着，写入已经完成
+    release.set()
+    reader.join(1.0)
+    assert not reader.is_alive()
+
+# ================================================================
+# 语音口令：Aho-Corasick 匹配
+# ================================================================
+def matcher(*phrases):
+    return smarthome.PhraseMatcher([(smarthome.normalize_phrase(p), p) for p in phrases])
+
+
+def test_phrase_matcher_longest_match_wins():
+    m = matcher("lights on", "turn off the lights", "turn off the lights in the bedroom")
+    text = smarthome.normalize_phrase("Please turn off the lights in the bedroom!")
+    assert m.best(text) == "turn off the lights in the bedroom"
+
+
+def test_phrase_matcher_tie_goes_to_earlier_entry():
+    m = matcher("main on", "hall on")
+    assert m.best(smarthome.normalize_phrase("hall on main on")) == "main on"
+
+
+def test_phrase_matcher_whole_words_only():
+    m = matcher("on")
+    assert m.best(smarthome.normalize_phrase("bonjour")) is None
+    assert m.best(smarthome.normalize_phrase("on")) == "on"
+
+
+def test_phrase_matcher_overlapping_phrases_via_fail_links():
+    # "he" 是 "she" 的后缀、"hers" 的前缀：经典 Aho-Corasick 例子
+    m = smarthome.PhraseMatcher([("he", 0), ("she", 1), ("his", 2), ("hers", 3)])
+    found = sorted(m.values[i] for _, i in m.matches("ushers"))
+    assert found == [0, 1, 3]
+
+
+def test_default_intents_cover_night_mode():
+    intents = smarthome.load_intents(os.environ["SMARTHOME_INTENTS"])
+    intent = intents.best(smarthome.normalize_phrase("turn on night mode please"))
+    assert intent is not None and "night_on" in intent.get("commands", [])
+
+
+def test_load_intents_skips_bad_entries(tmp_path):
+    path = tmp_path / "intents.json"
+    path.write_text(json.dumps([
+        {"phrases": ["no name"], "commands": ["main_on"], "reply": "x"},
+        {"name": "no_phrases", "commands": ["main_on"], "reply": "x"},
+        {"name": "bad_phrases", "phrases": "hall on", "commands": ["hall_on"], "reply": "x"},
+        {"name": "bad_scene", "phrases": ["x"], "scene": ["home"], "reply": "x"},
+        {"name": "unknown", "phrases": ["attic on"], "commands": ["attic_on"], "reply": "x"},
+        "main_on",
+        {"name": "ok", "phrases": ["lights please"], "commands": ["all_on"], "reply": "ok"},
+    ]))
+    matcher = smarthome.load_intents(str(path))
+    assert [v["name"] for v in matcher.values] == ["ok"]
+
+
+# ================================================================
+# 事件日志：快照 + 尾部重放
+# ================================================================
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "journal.db")
+
+
+def test_journal_restore_replays_events(journal_path):
+    journal = smarthome.Journal(journal_path)
+    journal.record("state", "main", True, "http")
+    journal.record("state", "hall", True, "http")
+    journal.record("state", "main", False, "ws")
+    journal.record("alarm", "high_temp", True, "alarm", "31.5")   # 报警不算设备状态
+    journal.flush()
+    states, replayed = smarthome.Journal(journal_path).restore()
+    assert states == {"main": False, "hall": True}
+    assert replayed == 3
+
+
+def test_journal_snapshot_limits_replay_to_tail(journal_path, monkeypatch):
+    monkeypatch.setattr(smarthome, "JOURNAL_SNAPSHOT_EVERY", 3)
+    journal = smarthome.Journal(journal_path)
+    for i in range(4):
+        journal.record("state", "main", i % 2 == 0)
+    journal.flush()                      # 4 个事件，和快照在同一个事务里
+    journal.record("state", "bedroom", True)
+    journal.flush()
+
+    states, replayed = smarthome.Journal(journal_path).restore()
+    assert states == {"main": False, "bedroom": True}
+    assert replayed == 1                 # 只重放快照之后的事件
+
+
+def test_journal_keeps_only_recent_snapshots(journal_path, monkeypatch):
+    monkeypatch.setattr(smarthome, "JOURNAL_SNAPSHOT_EVERY", 1)
+    journal = smarthome.Journal(journal_path)
+    for i in range(5):
+        journal.record("state", "hall", i % 2 == 0)
+        journal.flush()
+    count = journal.conn.execute("SELECT COUNT(*) FROM snapshots").fetchone()[0]
+    assert count == smarthome.JOURNAL_SNAPSHOTS_KEEP
+    assert smarthome.Journal(journal_path).restore() == ({"hall": True}, 0)
+
+
+def test_journal_query_filters_by_name_and_time(journal_path):
+    journal = smarthome.Journal(journal_path)
+    for name in ("main", "hall", "main", "bedroom", "main"):
+        journal.record("state", name, True)
+    journal.flush()
+    rows = journal.query(name="main")
+    assert [r[3] for r in rows] == ["main"] * 3
+    assert [r[0] for r in rows] == sorted((r[0] for r in rows), reverse=True)   # 新的在前
+    assert [r[0] for r in journal.query(name="main", before=rows[0][0])] == [r[0] for r in rows[1:]]
+    assert journal.query(t0=time.time() + 60) == []
+    plan = journal.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM journal WHERE name = 'main' AND ts >= 0").fetchall()
+    assert "journal_name_ts" in str(plan)
+
+
+# ================================================================
+# 用电统计：按小时 / 天切分
+# ================================================================
+DAY = 86400
+T0 = 1_700_000_000 // DAY * DAY          # 某个 UTC 零点
+
+
+def test_split_interval_within_one_bucket():
+    assert list(smarthome.split_interval(T0 + 60, T0 + 600, 3600)) == [(T0, 540)]
+
+
+def test_split_interval_across_hours():
+    pieces = list(smarthome.split_interval(T0 + 3000, T0 + 7800, 3600))
+    assert pieces == [(T0, 600), (T0 + 3600, 3600), (T0 + 7200, 600)]
+    assert sum(s for _, s in pieces) == 4800
+
+
+def test_split_interval_across_utc_midnight():
+    pieces = list(smarthome.split_interval(T0 - 1800, T0 + 1800, DAY))
+    assert pieces == [(T0 - DAY, 1800), (T0, 1800)]
+
+
+def test_split_interval_local_midnight():
+    # UTC+8：本地零点是 UTC 16:00，UTC 零点前后的一小时属于本地的同一天
+    offset = 8 * 3600
+    assert list(smarthome.split_interval(T0 - 1800, T0 + 1800, DAY, offset)) == [(T0 - offset, 3600)]
+    local_midnight = T0 + DAY - offset
+    assert list(smarthome.split_interval(local_midnight - 60, local_midnight + 60, DAY, offset)) == [
+        (local_midnight - DAY, 60), (local_midnight, 60)]
+
+
+def test_split_interval_empty():
+    assert list(smarthome.split_interval(T0, T0, 3600)) == []
+
+
+def test_usage_meter_accumulates_on_time():
+    meter = smarthome.UsageMeter(smarthome.registry.devices)
+    now = time.time()
+    meter.switch("main", True, now - 1800)
+    meter.switch("main", True, now - 900)     # 已经亮着，不重新计时
+    meter.switch("main", False, now)
+    meter.switch("hall", False, now)           # 本来就是关的
+    _, out = meter.report(3600, 2, ["main", "hall"])
+    assert out["main"]["total_seconds"] == pytest.approx(1800, abs=0.1)
+    assert out["main"]["turn_ons"] == 1
+    assert out["main"]["total_wh"] == pytest.approx(1800 * out["main"]["watts"] / 3600, abs=0.01)
+    assert out["hall"]["total_seconds"] == 0
+
+
+# ================================================================
+# HTTP 接口：请求体校验
+# ================================================================
+@pytest.fixture
+def client():
+    return smarthome.app.test_client()
+
+
+@pytest.mark.parametrize("body", [[1, 2], "main_on", {"scene": ["x"]}, {"commands": "main_on"}])
+def test_actions_rejects_malformed_body(client, body):
+    resp = client.post("/api/actions", json=body)
+    assert resp.status_code == 400
+    assert "error" in resp.get_json()
+
+
+@pytest.mark.parametrize("frame", ['[1, 2]', '"x"', 'null', '{"id": 1, "scene": ["x"]}', '{"id": 1}', 'not json'])
+def test_ws_handle_acks_malformed_frames(frame):
+    reply = json.loads(smarthome.ws_handle(frame))
+    assert reply["type"] == "ack" and reply["ok"] is False
+
+
+@pytest.mark.parametrize("body", [["turn on main light"], "turn on main light", {"text": 1}])
+def test_intent_rejects_malformed_body(client, body):
+    assert client.post("/api/intent", json=body).status_code == 400
+
+
+
+@pytest.mark.parametrize("query", ["from=nan", "to=inf", "from=abc", "limit=x"])
+def test_journal_rejects_bad_numbers(client, query):
+    assert client.get("/api/journal?" + query).status_code == 400